@@ -0,0 +1,113 @@
+"""
+RL - Copyright © 2023 Iván Belenky @Leculette
+
+Policy evaluation benchmark on the gridworld of examples/gridworld.py,
+scaled from 5x5 up to 100x100. Compares the former diag-of-full-product
+sweep against the row-wise contraction sweep and the exact linear solve.
+
+    python benchmarks/policy_evaluation.py
+"""
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+from numpy.linalg import norm as lnorm
+
+from rl.mdp import MDP, TabularReward
+from rl.solvers import vq_π_iter_naive, vq_π_linear
+from rl.utils import TOL, MAX_ITER
+
+GRID_SIZES = [5, 10, 20, 40, 100]
+DIAG_MAX_SIZE = 40 # SxS intermediates do not fit in memory past this
+
+
+def gridworld(grid_size, use_sparse=False):
+    '''
+    Same layout as examples/gridworld.py: A=(0,1) teleports to (4,1) with
+    +10, B=(0,3) teleports to (2,3) with +5, bumping a border costs -1.
+    '''
+    S, A = grid_size**2, 4
+    idx = np.arange(S).reshape(grid_size, grid_size)
+    i, j = np.divmod(np.arange(S), grid_size)
+
+    next_s = np.stack([
+        idx[np.maximum(i-1, 0), j],
+        idx[i, np.minimum(j+1, grid_size-1)],
+        idx[np.minimum(i+1, grid_size-1), j],
+        idx[i, np.maximum(j-1, 0)]], axis=1) #SxA
+
+    r_sa = np.zeros((S, A))
+    r_sa[i == 0, 0] = -1
+    r_sa[j == grid_size-1, 1] = -1
+    r_sa[i == grid_size-1, 2] = -1
+    r_sa[j == 0, 3] = -1
+
+    for (s, a), (target, reward) in {
+        (idx[0, 0], 1): (idx[4, 1], 10), (idx[0, 2], 3): (idx[4, 1], 10),
+        (idx[1, 1], 0): (idx[4, 1], 10), (idx[0, 2], 1): (idx[2, 3], 5),
+        (idx[0, 4], 3): (idx[2, 3], 5), (idx[1, 3], 0): (idx[2, 3], 5),
+    }.items():
+        next_s[s, a] = target
+        r_sa[s, a] += reward
+
+    rows = np.arange(S*A)
+    p_s = sparse.csr_matrix((np.ones(S*A), (rows, next_s.ravel())),
+        shape=(S*A, S))
+    if not use_sparse:
+        p_s = p_s.toarray().reshape(S, A, S)
+
+    return MDP(p_s, np.arange(S), np.arange(A), gamma=0.9,
+        reward_gen=TabularReward(r_sa))
+
+
+def _vq_π_iter_diag(MDP, policy, tol=TOL, max_iters=MAX_ITER):
+    '''former vq_π_iter_naive sweep, kept as reference'''
+    γ = MDP.gamma
+
+    vᵢ = np.ones(MDP.S)
+    diff_norm = TOL*2
+
+    π_sa = np.array([policy.π(s) for s in range(MDP.S)]) #SxA
+    r_sa  = np.array([[MDP.r_sa(s,a) for s in range(MDP.S)]
+        for a in range(MDP.A)]) #AxS
+
+    n_iter = 0
+    while (n_iter < max_iters) and (diff_norm > tol):
+        vᵢ_1 = vᵢ.copy()
+
+        vᵢ = np.diag(π_sa @ r_sa)
+        vᵢ = vᵢ + γ * np.diag(MDP.p_sv(vᵢ_1) @ π_sa.T)
+
+        diff_norm = lnorm(vᵢ - vᵢ_1)
+        n_iter += 1
+
+    return vᵢ
+
+
+def _timeit(f, *args):
+    t0 = time.perf_counter()
+    out = f(*args)
+    return time.perf_counter() - t0, out
+
+
+def main():
+    print(f"{'grid':>8} {'backend':>8} {'diag':>10} {'einsum':>10} "
+        f"{'linear':>10} {'max |Δv|':>10}")
+    for grid_size in GRID_SIZES:
+        for use_sparse in (False, True):
+            if not use_sparse and grid_size > DIAG_MAX_SIZE:
+                continue
+            mdp = gridworld(grid_size, use_sparse)
+            t_e, (v_e, _) = _timeit(vq_π_iter_naive, mdp, mdp.policy)
+            t_l, (v_l, _) = _timeit(vq_π_linear, mdp, mdp.policy)
+            t_d = '-'
+            if grid_size <= DIAG_MAX_SIZE:
+                t, _ = _timeit(_vq_π_iter_diag, mdp, mdp.policy)
+                t_d = f'{t:.4f}'
+            print(f"{grid_size:>4}x{grid_size:<3} "
+                f"{'sparse' if use_sparse else 'dense':>8} {t_d:>10} "
+                f"{t_e:>10.4f} {t_l:>10.4f} {np.abs(v_e - v_l).max():>10.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+RL - Copyright © 2023 Iván Belenky @Leculette
+
+Full versus modified policy iteration (k evaluation sweeps per
+improvement) on the scaled gridworld of benchmarks/policy_evaluation.py.
+
+    python benchmarks/policy_iteration.py
+"""
+import time
+
+import numpy as np
+
+from policy_evaluation import gridworld
+
+GRID_SIZES = [5, 20, 50]
+KS = [None, 20, 5, 1]
+
+
+def main():
+    print(f"{'grid':>8} {'k':>6} {'improvements':>13} {'time':>10} {'max |Δv|':>10}")
+    for grid_size in GRID_SIZES:
+        v_ref = None
+        for k in KS:
+            mdp = gridworld(grid_size, use_sparse=True)
+            t0 = time.perf_counter()
+            v, _, n_iter = mdp.optimize_policy('policy_iteration', k=k)
+            t = time.perf_counter() - t0
+            v_ref = v if v_ref is None else v_ref
+            print(f"{grid_size:>4}x{grid_size:<3} {str(k or 'full'):>6} "
+                f"{n_iter:>13} {t:>10.4f} {np.abs(v - v_ref).max():>10.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+RL - Copyright © 2023 Iván Belenky @Leculette
+
+Sweeps to tolerance and wall time of each value iteration sweep order,
+on the scaled gridworld of benchmarks/policy_evaluation.py. In place
+orders update block states at once and only order the blocks, so they
+run with the default SWEEP_BLOCK and with block=1, true per state
+sweeps.
+
+    python benchmarks/value_iteration.py
+"""
+import time
+
+import numpy as np
+
+from policy_evaluation import gridworld
+from rl.solvers import SWEEP_MAP, SWEEP_BLOCK
+
+GRID_SIZES = [5, 20, 50]
+
+
+def main():
+    print(f"{'grid':>8} {'sweep':>14} {'block':>6} {'sweeps':>8} {'time':>10}"
+        f" {'max |Δv|':>10}")
+    for grid_size in GRID_SIZES:
+        v_ref = None
+        for sweep in SWEEP_MAP:
+            for block in ([None] if sweep == 'jacobi' else [SWEEP_BLOCK, 1]):
+                kwargs = {} if block is None else {'block': block}
+                mdp = gridworld(grid_size, use_sparse=True)
+                t0 = time.perf_counter()
+                v, _, n_iter = mdp.optimize_policy('value_iteration', 
+                    sweep=sweep, **kwargs)
+                t = time.perf_counter() - t0
+                v_ref = v if v_ref is None else v_ref
+                print(f"{grid_size:>4}x{grid_size:<3} {sweep:>14} "
+                    f"{block or '-':>6} {n_iter:>8} {t:>10.4f} "
+                    f"{np.abs(v - v_ref).max():>10.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,18 @@
-from .model_free import ModelFree, ModelFreePolicy, EpsilonSoftPolicy, TransitionException
+from .model_free import (
+    ModelFree,
+    ModelFreePolicy,
+    EpsilonSoftPolicy,
+    GreedyPolicy,
+    EmpiricalModel,
+    EpisodeBuffer,
+    EpisodeStore,
+    TransitionException
+)
 from .solvers import (
     tdn, 
     alpha_mc, 
     off_policy_mc,
+    off_policy_eval,
     dynaq
 )
 
@@ -11,9 +21,14 @@ __all__ = [
     'ModelFree',
     'ModelFreePolicy',
     'EpsilonSoftPolicy',
+    'GreedyPolicy',
+    'EmpiricalModel',
+    'EpisodeBuffer',
+    'EpisodeStore',
     'tdn',
     'alpha_mc',
     'off_policy_mc',
+    'off_policy_eval',
     'dynaq',
     'TransitionException'
 ]
\ No newline at end of file
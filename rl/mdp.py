@@ -13,6 +13,10 @@ from typing import Tuple, List
 from abc import ABC, abstractmethod
 
 import numpy as np
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
 
 from rl.utils import (
     State,
@@ -20,8 +24,9 @@ from rl.utils import (
     Policy,
     RewardGenerator
 )
-from solvers import (
+from rl.solvers import (
     vq_π_iter_naive,
+    vq_π_linear,
     policy_iteration,
     value_iteration
 )
@@ -30,6 +35,10 @@ PROB_TOL = 1E-3
 ESTIMATE_ITERS = int(1E3)
 
 
+def _issparse(p_s) -> bool:
+    return sparse is not None and sparse.issparse(p_s)
+
+
 class MarkovReward(ABC):
     @abstractmethod
     def generate(self, state: int, action: int) -> float:
@@ -47,11 +56,27 @@ class MarkovReward(ABC):
         '''
         r(s,a) = E[Rt|St-1 = s, At-1 = a]
         '''
-        p = p_s[state][action]
+        if _issparse(p_s):
+            A = p_s.shape[0] // p_s.shape[1]
+            p = p_s[state*A + action].toarray().ravel()
+        else:
+            p = p_s[state][action]
         r = 0
-        for i,ps in enumerate(p):            
-            r += ps*self.mean(state=self.states[i])
+        for i,ps in enumerate(p):
+            if ps:
+                r += ps*self.r_sas(i)
         return r 
+
+    def r_sa_matrix(self, p_s: np.ndarray) -> np.ndarray:
+        '''
+        r(s,a) for every state and action as a SxA matrix, computed in
+        a single product against r(s') = r_sas(s').
+        '''
+        S = p_s.shape[-1]
+        r_s = np.array([self.r_sas(s) for s in range(S)])
+        if _issparse(p_s):
+            return (p_s @ r_s).reshape(S, p_s.shape[0] // S)
+        return p_s @ r_s
         
 
 class TabularReward(MarkovReward):
@@ -75,6 +100,9 @@ class TabularReward(MarkovReward):
     
     def r_sa(self, p_s: np.ndarray, state: int, action: int):
         return self._r_sa[state][action]
+
+    def r_sa_matrix(self, p_s: np.ndarray) -> np.ndarray:
+        return self._r_sa
     
     def r_sas(self, next_state: int) -> float:
         return np.mean(self._r_sa[next_state])
@@ -126,14 +154,8 @@ class MarkovPolicy(Policy):
         multiple actions that maximize Q(s,a) then the policy is
         updated to be equally probable among those actions.
         '''
-        self.pi_sa = np.array([self._update_policy(q_pi, s) 
-            for s in range(self.s)])
-
-    def _update_policy(self, q_pi: np.ndarray, state: int) -> np.ndarray:
-        q_sa = q_pi.T[state]
-        max_q = max(q_sa)
-        max_q_sa = np.array([q_sa[a] == max_q for a in range(self.a)])
-        return max_q_sa / sum(max_q_sa)
+        max_q_sa = (q_pi == np.max(q_pi, axis=0)).T
+        self.pi_sa = max_q_sa / max_q_sa.sum(axis=1, keepdims=True)
 
     def π(self, state: int):
         '''
@@ -151,7 +173,8 @@ class MarkovPolicy(Policy):
 
 class MDP:
     VQ_PI_SOLVERS = {
-        'iter_n': vq_π_iter_naive
+        'iter_n': vq_π_iter_naive,
+        'linear': vq_π_linear,
     }
 
     OPTIMAL_POLICY_SOLVERS = {
@@ -168,7 +191,14 @@ class MDP:
         policy: Policy = None,
         reward_gen: RewardGenerator = None,
     ):
-        self.p_s = p_s
+        '''
+        p_s: transition tensor p(s'|s,a), either a dense array of shape
+            SxAxS or a scipy.sparse matrix of shape (S·A)xS where row
+            s·A + a holds p(·|s,a). Sparse models are stored as CSR so
+            memory and sweeps scale with the nonzero transitions.
+        '''
+        self.sparse = _issparse(p_s)
+        self.p_s = p_s.tocsr() if self.sparse else p_s
         self.states = states
         self.actions = actions
         self.gamma = gamma
@@ -192,22 +222,73 @@ class MDP:
     def _validate_attr(self):
         S = self.states.shape[0]
         A = self.actions.shape[0]
-        if self.p_s.shape != (S, A, S):
-            raise ValueError(
-                "p_s must be of shape " +
-                f"(n_states, n_actions, n_states) = ({S}, {A}, {S})")
-        
-        for i in range(S):
-            if not np.allclose(self.p_s[i].sum(axis=1), 1, atol=PROB_TOL):
+        if self.sparse:
+            if self.p_s.shape != (S*A, S):
+                raise ValueError(
+                    "sparse p_s must be of shape " +
+                    f"(n_states*n_actions, n_states) = ({S*A}, {S})")
+            row_sums = np.asarray(self.p_s.sum(axis=1)).ravel()
+            if not np.allclose(row_sums, 1, atol=PROB_TOL):
+                raise ValueError("Each row must sum to 1")
+        else:
+            if self.p_s.shape != (S, A, S):
+                raise ValueError(
+                    "p_s must be of shape " +
+                    f"(n_states, n_actions, n_states) = ({S}, {A}, {S})")
+
+            if not np.allclose(self.p_s.sum(axis=2), 1, atol=PROB_TOL):
                 raise ValueError("Each row must sum to 1")
 
         if self.gamma > 1 or self.gamma < 0: 
             raise ValueError(
                 f"discounted rate gamma has to be in range [0, 1]")
 
+    def p_sa(self, state: int, action: int) -> np.ndarray:
+        '''
+        p(·|s=state, a=action) as a dense vector of size S
+        '''
+        if self.sparse:
+            return self.p_s[state*self.A + action].toarray().ravel()
+        return self.p_s[state][action]
+
+    def p_sv(self, v: np.ndarray) -> np.ndarray:
+        '''
+        Σ_s' p(s'|s,a)v(s') as a SxA matrix
+        '''
+        if self.sparse:
+            return (self.p_s @ v).reshape(self.S, self.A)
+        return self.p_s @ v
+
+    def p_rows(self, states: slice):
+        '''
+        p(·|s,a) for the states in a slice, as a view of shape kxAxS if
+        dense or a (k·A)xS CSR matrix if sparse
+        '''
+        if self.sparse:
+            return self.p_s[states.start*self.A:states.stop*self.A]
+        return self.p_s[states]
+
+    def p_pi(self, π_sa: np.ndarray) -> np.ndarray:
+        '''
+        P_π(s,s') = Σ_a π(a|s)p(s'|s,a) as a SxS matrix, sparse if p_s is
+        '''
+        if self.sparse:
+            rows = np.repeat(np.arange(self.S), self.A)
+            cols = np.arange(self.S*self.A)
+            π_op = sparse.csr_matrix((π_sa.ravel(), (rows, cols)),
+                shape=(self.S, self.S*self.A))
+            return π_op @ self.p_s
+        return np.einsum('sa,sat->st', π_sa, self.p_s)
+
     def r_sa(self, state: int, action: int) -> float:
         return self.reward_gen.r_sa(self.p_s, state, action)
     
+    def r_sa_matrix(self) -> np.ndarray:
+        '''
+        r(s,a) as a SxA matrix
+        '''
+        return self.reward_gen.r_sa_matrix(self.p_s)
+
     def r_sas(self, next_s: int) -> float:
         return self.reward_gen.r_sas(next_s)
 
@@ -234,23 +315,32 @@ class MDP:
     def optimize_policy(
         self, 
         method: str = 'policy_iteration',
-        policy: MarkovPolicy = None
-        ) -> MarkovPolicy:
+        policy: MarkovPolicy = None,
+        **kwargs
+        ) -> Tuple[np.ndarray, np.ndarray, int]:
         '''
         Optimal policy is the policy that maximizes the expected
         discounted return. It is the policy that maximizes the
         value function for each possible state.
+
+        The policy, self.policy by default, is updated in place to the
+        optimal one. Returns v, q and the number of iterations run: 
+        policy improvements for policy_iteration, sweeps for 
+        value_iteration.
+
+        Extra keyword arguments are passed to the solver, e.g.
+        sweep='gauss_seidel' for value_iteration.
         '''
         policy = policy if policy else self.policy
         solver = self.OPTIMAL_POLICY_SOLVERS.get(method)
         if not solver:
             raise ValueError(f"Method {method} does not exist")
         
-        solver(self, policy)
+        return solver(self, policy, **kwargs)
         
 
     def __call__(self, state: int = 0) -> Tuple[int, float]:
-        p = self.p_s[state][self.policy(state)]
+        p = self.p_sa(state, self.policy(state))
         next_state = np.random.choice(self.states, p=p)
         self.curr_state = next_state
         reward = self.reward_gen.generate(next_state)
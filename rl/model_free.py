@@ -12,20 +12,33 @@ from typing import (
     NewType, 
 )
 
+import os
+import hashlib
+
 import numpy as np
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
 
 from rl.utils import (
     Policy, 
     State, 
+    MixedRadixState,
     Action,
     StateAction, 
     MAX_ITER, 
-    MAX_STEPS
+    MAX_STEPS,
+    _check_ranges
 )
 
+COMPILE_PROBES = 8 # probes per (s,a) to call a transition deterministic
+
 
 EpisodeStep = NewType(
     'EpisodeStep', Tuple[int, int, float])
+Episode = NewType(
+    'Episode', Tuple[np.ndarray, np.ndarray, np.ndarray])
 
 
 class TransitionException(Exception):
@@ -33,24 +46,105 @@ class TransitionException(Exception):
 
 
 class ModelFreePolicy(Policy):
-    def __init__(self, A: Union[Sequence[Any], int], S: Union[Sequence[Any], int]):
+    '''
+    Tabular policy π(a|s) held as a SxA matrix pi. Actions are sampled
+    from per state cumulative distributions, cached and only recomputed
+    for the states whose row changed, against uniforms drawn a block of
+    UNIFORM_BLOCK at a time.
+
+    Assigning pi or calling update_policy keeps the cache in step. Rows
+    written in place, pi[s] = ..., once sampling has started need an
+    invalidate() call.
+    '''
+    UNIFORM_BLOCK = 4096
+
+    def __init__(self, A: Union[Sequence[Any], int], S: Union[Sequence[Any], int],
+        pi: np.ndarray = None):
         if not isinstance(A, int):
             A = len(A)
         if not isinstance(S, int):
             S = len(S)
         self.A = A
         self.S = S
-        self.pi = np.ones((S, A))/A
+        self._set_pi(pi)
+        self._mask = np.empty(A, dtype=bool)
+        self._u, self._u_i = np.empty(0), 0
+
+    @property
+    def pi(self) -> np.ndarray:
+        return self._pi
+
+    @pi.setter
+    def pi(self, pi: np.ndarray):
+        self._set_pi(pi)
+
+    def _set_pi(self, pi: np.ndarray):
+        # None stands for the equally probable policy
+        self._pi = pi if pi is not None else np.ones((self.S, self.A))/self.A
+        self._cdf = None # allocated on first sample
+        self.invalidate()
+
+    def invalidate(self, states: Union[np.ndarray, int] = None):
+        '''
+        Marks the cached distributions of states, all if None, as stale
+        '''
+        if states is None:
+            self._stale = np.ones(self._pi.shape[0], dtype=bool)
+        else:
+            self._stale[states] = True
+
+    def _refresh(self, states: np.ndarray):
+        if self._cdf is None:
+            self._cdf = np.empty(self._pi.shape)
+        stale = states[self._stale[states]]
+        if stale.size:
+            self._cdf[stale] = np.cumsum(self._pi[stale], axis=1)
+            self._stale[stale] = False
+
+    def _uniform(self) -> float:
+        if self._u_i == self._u.shape[0]:
+            self._u, self._u_i = np.random.rand(self.UNIFORM_BLOCK), 0
+        self._u_i += 1
+        return self._u[self._u_i - 1]
+
+    def __getstate__(self) -> dict:
+        # copies, e.g. in worker processes, must not share uniforms
+        state = self.__dict__.copy()
+        state['_u'], state['_u_i'] = np.empty(0), 0
+        return state
 
     def __call__(self, state: int):
-        return np.random.choice(self.A, p=self.pi[state])
+        if self._stale[state]:
+            if self._cdf is None:
+                self._cdf = np.empty(self._pi.shape)
+            self._cdf[state] = np.cumsum(self._pi[state])
+            self._stale[state] = False
+        a = self._cdf[state].searchsorted(self._uniform(), side='right')
+        return min(int(a), self.A - 1)
+
+    def sample(self, states: np.ndarray) -> np.ndarray:
+        '''
+        Batched __call__, one action index per state index in states.
+        '''
+        states = np.asarray(states)
+        self._refresh(states)
+        u = np.random.rand(states.shape[0], 1)
+        return np.minimum((u >= self._cdf[states]).sum(axis=1), self.A - 1)
 
     def pi_as(self, action: int, state: int):
-        return self.pi[state, action]
+        return self._pi[state, action]
+
+    def pi_s(self, states: Union[np.ndarray, int]) -> np.ndarray:
+        '''
+        π(·|s) for every state in states
+        '''
+        return self._pi[states]
     
     def update_policy(self, q, s):
-        qs_mask = (q[s] == np.max(q[s]))
-        self.pi[s] = np.where(qs_mask, 1.0/qs_mask.sum(), 0)
+        q_s = q[s]
+        qs_mask = np.equal(q_s, q_s.max(), out=self._mask)
+        np.divide(qs_mask, qs_mask.sum(), out=self._pi[s])
+        self._stale[s] = True
         
     def _make_deterministic(self):
         self.pi = np.eye(self.A)[np.argmax(self.pi, axis=1)]
@@ -64,10 +158,326 @@ class EpsilonSoftPolicy(ModelFreePolicy):
     def update_policy(self, q, s):
         # if there are multiple actions with the same value,
         # then we choose one of them randomly
-        max_q = np.max(q[s])
-        qs_mask = (q[s] == max_q)
-        self.pi[s] = self.Ɛ/self.A
-        self.pi[s, qs_mask] += (1 - self.Ɛ)/qs_mask.sum()
+        q_s = q[s]
+        qs_mask = np.equal(q_s, q_s.max(), out=self._mask)
+        pi_s = np.multiply(qs_mask, (1 - self.Ɛ)/qs_mask.sum(), 
+            out=self._pi[s])
+        pi_s += self.Ɛ/self.A
+        self._stale[s] = True
+
+
+class GreedyPolicy(ModelFreePolicy):
+    '''
+    ε-greedy policy read straight from a live Q table instead of a stored
+    SxA pi matrix: with probability ε a uniformly random action, else one
+    of the actions with the highest q(s,·), ties broken at random. With
+    eps=0 it is the greedy policy.
+
+    update_policy(q, s) only keeps a reference to q, so policy updates
+    cost nothing and whatever changed q is seen by the next action. Until
+    then, or if no q is given, every action is equally probable, as for
+    a ModelFreePolicy never updated. pi is materialized on demand, and
+    pi_as and pi_s work out the rows they need.
+    '''
+
+    def __init__(self, A: Union[Sequence[Any], int], 
+        S: Union[Sequence[Any], int], eps: float = 0., q: np.ndarray = None):
+        super().__init__(A, S)
+        self.Ɛ = eps
+        self.q = q
+
+    @property
+    def pi(self) -> np.ndarray:
+        return self.pi_s(np.arange(self.S))
+
+    @pi.setter
+    def pi(self, pi: np.ndarray):
+        raise AttributeError("GreedyPolicy derives pi from q, it can not be set")
+
+    def _set_pi(self, pi):
+        # no table nor cached distributions, rows come from q
+        self._pi = self._cdf = self._stale = None
+
+    def invalidate(self, states: Union[np.ndarray, int] = None):
+        pass
+
+    def pi_s(self, states: Union[np.ndarray, int]) -> np.ndarray:
+        if self.q is None:
+            return np.full(np.shape(states) + (self.A,), 1/self.A)
+        q_s = self.q[states]
+        qs_mask = q_s == q_s.max(axis=-1, keepdims=True)
+        return qs_mask * ((1 - self.Ɛ)/qs_mask.sum(axis=-1, keepdims=True)) \
+            + self.Ɛ/self.A
+
+    def pi_as(self, action: Union[np.ndarray, int], 
+        state: Union[np.ndarray, int]):
+        if self.q is None:
+            return np.full(np.shape(state), 1/self.A)[()]
+        q_s = self.q[state]
+        q_max = q_s.max(axis=-1, keepdims=True)
+        greedy = np.take_along_axis(q_s, np.expand_dims(action, -1), -1) \
+            == q_max
+        p = greedy * ((1 - self.Ɛ)/(q_s == q_max).sum(axis=-1, keepdims=True)) \
+            + self.Ɛ/self.A
+        return p[..., 0][()]
+
+    def __call__(self, state: int):
+        u = self._uniform()
+        if self.q is None:
+            return min(int(u*self.A), self.A - 1)
+        if u < self.Ɛ:
+            return min(int(u/self.Ɛ*self.A), self.A - 1)
+
+        q_s = self.q[state]
+        ties = np.flatnonzero(q_s == q_s.max())
+        k = ties.shape[0]
+        return int(ties[min(int((u - self.Ɛ)/(1 - self.Ɛ)*k), k - 1)])
+
+    def sample(self, states: np.ndarray) -> np.ndarray:
+        cdf = np.cumsum(self.pi_s(np.asarray(states)), axis=1)
+        u = np.random.rand(cdf.shape[0], 1)
+        return np.minimum((u >= cdf).sum(axis=1), self.A - 1)
+
+    def update_policy(self, q, s):
+        self.q = q
+
+    def _make_deterministic(self):
+        self.Ɛ = 0.
+
+
+class EpisodeBuffer:
+    '''
+    Reusable struct of arrays storage for one episode: int32 states and
+    actions and float64 rewards, grown geometrically as steps are
+    appended. s, a and r are views of the T steps stored so far, only
+    valid until the buffer is reset and written again.
+    '''
+
+    def __init__(self, size: int = 64):
+        self._s = np.empty(size, dtype=np.int32)
+        self._a = np.empty(size, dtype=np.int32)
+        self._r = np.empty(size, dtype=np.float64)
+        self.T = 0
+
+    def __len__(self) -> int:
+        return self.T
+
+    def _grow(self, size: int):
+        for name in ('_s', '_a', '_r'):
+            old = getattr(self, name)
+            new = np.empty(size, dtype=old.dtype)
+            new[:self.T] = old[:self.T]
+            setattr(self, name, new)
+
+    def reset(self):
+        self.T = 0
+
+    def append(self, step: EpisodeStep):
+        '''appends an (s, a, r) step, as for a list of EpisodeStep'''
+        if self.T == self._s.shape[0]:
+            self._grow(max(1, 2*self.T))
+        self._s[self.T], self._a[self.T], self._r[self.T] = step
+        self.T += 1
+
+    def extend(self, s: np.ndarray, a: np.ndarray, r: np.ndarray):
+        T = self.T + s.shape[0]
+        if T > self._s.shape[0]:
+            self._grow(max(T, 2*self._s.shape[0]))
+        self._s[self.T:T], self._a[self.T:T], self._r[self.T:T] = s, a, r
+        self.T = T
+
+    @property
+    def s(self) -> np.ndarray:
+        return self._s[:self.T]
+
+    @property
+    def a(self) -> np.ndarray:
+        return self._a[:self.T]
+
+    @property
+    def r(self) -> np.ndarray:
+        return self._r[:self.T]
+
+
+class EpisodeStore:
+    '''
+    Append only on disk store of episodes. The states, actions, rewards
+    and behavior probabilities b(a_t|s_t) of every episode are written
+    contiguously to s.bin, a.bin, r.bin and b.bin under path, and
+    offsets.bin holds the cumulative end of each episode. Offsets are
+    written last, so an episode only counts once it is complete, and
+    anything past the last offset is dropped when the store is opened
+    again.
+
+    Reads are memory mapped: indexing or iterating returns (s, a, r)
+    views of the files, so stored episodes can be replayed into the
+    solvers without simulating them again nor loading the whole store.
+    The behavior probabilities are kept apart in b, NaN where unknown,
+    for off-policy evaluation.
+    '''
+
+    FIELDS = {'s': np.int32, 'a': np.int32, 'r': np.float64, 'b': np.float64}
+
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+        offsets = self._file('offsets')
+        n = os.path.getsize(offsets) // 8 if os.path.exists(offsets) else 0
+        ends = np.fromfile(offsets, dtype=np.int64) if n else np.zeros(1)
+        self._n, self._end = n, int(ends[-1])
+
+        self._files = {}
+        for k in (*self.FIELDS, 'offsets'):
+            f = open(self._file(k), 'ab')
+            size = 8*n if k == 'offsets' else \
+                self._end*np.dtype(self.FIELDS[k]).itemsize
+            f.truncate(size)
+            self._files[k] = f
+        self._maps = None
+
+    def _file(self, k: str) -> str:
+        return os.path.join(self.path, f'{k}.bin')
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __enter__(self) -> 'EpisodeStore':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, s: np.ndarray, a: np.ndarray, r: np.ndarray,
+        b: np.ndarray = None):
+        if b is None:
+            b = np.full(len(s), np.nan)
+        for k, x in zip(self.FIELDS, (s, a, r, b)):
+            np.asarray(x, dtype=self.FIELDS[k]).tofile(self._files[k])
+        self._end += len(s)
+        self._n += 1
+        np.array([self._end], dtype=np.int64).tofile(self._files['offsets'])
+
+    def flush(self):
+        for f in self._files.values():
+            f.flush()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._maps = None
+
+    def _map(self) -> dict:
+        if self._maps is None or self._maps['n'] != self._n:
+            self.flush()
+            self._maps = {'n': self._n}
+            # plain ndarray views, slicing a np.memmap is much slower
+            for k, dtype in self.FIELDS.items():
+                self._maps[k] = np.asarray(np.memmap(self._file(k), 
+                    dtype=dtype, mode='r', shape=(self._end,))) \
+                    if self._end else np.empty(0, dtype=dtype)
+            ends = np.memmap(self._file('offsets'), dtype=np.int64,
+                mode='r', shape=(self._n,)) if self._n else np.empty(0, int)
+            self._maps['offsets'] = np.concatenate([[0], ends])
+        return self._maps
+
+    @property
+    def offsets(self) -> np.ndarray:
+        '''
+        Start of every episode plus the total number of steps, episode i
+        spans offsets[i]:offsets[i+1] of s, a and r.
+        '''
+        return self._map()['offsets']
+
+    @property
+    def s(self) -> np.ndarray:
+        return self._map()['s']
+
+    @property
+    def a(self) -> np.ndarray:
+        return self._map()['a']
+
+    @property
+    def r(self) -> np.ndarray:
+        return self._map()['r']
+
+    @property
+    def b(self) -> np.ndarray:
+        return self._map()['b']
+
+    def __getitem__(self, i: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError(f"Episode {i} out of range for {self._n} episodes")
+        m = self._map()
+        lo, hi = m['offsets'][i], m['offsets'][i+1]
+        return m['s'][lo:hi], m['a'][lo:hi], m['r'][lo:hi]
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield self[i]
+
+
+class EmpiricalModel:
+    '''
+    Tabular model of an environment estimated from k sampled transitions
+    per (s,a). Next state counts are stored as compact sparse triplets
+    (sa, s', count), with sa = s·A + a and s' = S standing for the end of
+    the episode, and r_sa holds the mean reward of every (s,a).
+
+    to_mdp exports it as an rl.mdp.MDP with S + 1 states, the last one
+    an absorbing, zero reward terminal state, so the model based solvers
+    can be run on it. save and load cache it on disk as a .npz file, along
+    with env, a fingerprint of the environment it was estimated from.
+    '''
+
+    def __init__(self, S: int, A: int, sa: np.ndarray, next_s: np.ndarray,
+        counts: np.ndarray, r_sa: np.ndarray, k: int, gamma: float = 1,
+        env: str = ''):
+        self.S = S
+        self.A = A
+        self.sa = sa
+        self.next_s = next_s
+        self.counts = counts
+        self.r_sa = r_sa
+        self.k = k
+        self.gamma = gamma
+        self.env = env
+
+    @property
+    def p_s(self):
+        '''
+        p(s'|s,a) as a sparse ((S+1)·A)x(S+1) matrix, terminal included
+        '''
+        S, A = self.S, self.A
+        terminal = np.arange(S*A, (S+1)*A)
+        rows = np.concatenate([self.sa, terminal])
+        cols = np.concatenate([self.next_s, np.full(A, S)])
+        data = np.concatenate([self.counts/self.k, np.ones(A)])
+        return sparse.csr_matrix((data, (rows, cols)), 
+            shape=((S+1)*A, S+1))
+
+    def to_mdp(self, gamma: float = None):
+        # rl.mdp depends on the solvers, which depend on this module
+        from rl.mdp import MDP, TabularReward
+
+        gamma = self.gamma if gamma is None else gamma
+        r_sa = np.vstack([self.r_sa, np.zeros((1, self.A))])
+        return MDP(self.p_s, np.arange(self.S+1), np.arange(self.A),
+            gamma=gamma, reward_gen=TabularReward(r_sa))
+
+    def save(self, path: str):
+        np.savez_compressed(path, S=self.S, A=self.A, sa=self.sa,
+            next_s=self.next_s, counts=self.counts, r_sa=self.r_sa,
+            k=self.k, gamma=self.gamma, env=self.env)
+
+    @classmethod
+    def load(cls, path: str) -> 'EmpiricalModel':
+        with np.load(path) as f:
+            return cls(int(f['S']), int(f['A']), f['sa'], f['next_s'],
+                f['counts'], f['r_sa'], int(f['k']), float(f['gamma']),
+                str(f['env']) if 'env' in f else '')
 
 
 class ModelFree:
@@ -80,27 +490,157 @@ class ModelFree:
     for this is when you want to generate arbitrary episodes of a
     specific environment. This class will stand in between of the
     user implemented transitions and validate its correct behavior. 
+
+    With vectorized=True the transition works on index arrays instead
+    of single values: it takes (states, actions) int arrays and returns
+    (next_states, rewards), ends arrays of the same length. This lets
+    generate_episodes advance many episodes in lockstep.
+
+    With deterministic=True the transition is probed for every (s,a) and
+    compiled into lookup tables, see compile_transitions. A transition
+    found to be stochastic raises a TransitionException.
+
+    If store is an EpisodeStore, every episode generated is appended to
+    it along with the probabilities of its actions under the policy, to
+    be replayed or evaluated off-policy later without simulating it again.
+
+    validate sets how many transitions are checked strictly. After that
+    the transition is trusted: no exception wrapping, type checks nor
+    extra index lookups. By default None, every transition is checked.
     '''
 
     def __init__(self, states: Sequence[Any], actions: Sequence[Any], 
-        transition: Callable, gamma: float = 1, policy: ModelFreePolicy = None
+        transition: Callable, gamma: float = 1, policy: ModelFreePolicy = None,
+        vectorized: bool = False, deterministic: bool = False, 
+        validate: int = None, store: EpisodeStore = None
     ):
     
         self.policy = policy
-        self.states = State(states)
+        self.states = states if isinstance(states, State) else State(states)
         self.actions = Action(actions)
-        self.stateaction = StateAction(
-            [(s,a) for s,a in zip(states, actions)])
+        self.stateaction = StateAction([(self.states.from_index(i), a) 
+            for i, a in zip(range(self.states.N), actions)])
         self.transition = transition
+        self.vectorized = vectorized
+        self.store = store
+        self._n_validate = validate
         self.gamma = gamma
         self.policy = policy if policy else ModelFreePolicy(
             self.actions.N, self.states.N)
+
+        self._table, self._steps = None, None
+        if deterministic:
+            self.compile_transitions(strict=True)
   
     def init_vq(self):
         v = np.zeros(self.states.N) 
         q = np.zeros((self.states.N, self.actions.N))
         return v,q 
 
+    @property
+    def compiled(self) -> bool:
+        return self._table is not None
+
+    def compile_transitions(self, n_probes: int = COMPILE_PROBES, 
+        strict: bool = False) -> bool:
+        '''
+        Probes the transition n_probes times for every (s,a) and, if all
+        probes agree, compiles it into SxA next state, reward and end
+        tables. Stepping then becomes plain table lookups, with no calls
+        to the transition nor index lookups.
+
+        Probes that disagree mean the transition is stochastic, in which
+        case a TransitionException is raised if strict, otherwise the
+        transition method keeps being used. Returns whether the
+        transition was compiled.
+
+        Probing can only disprove determinism: an outcome of (s,a) with
+        probability p other than the first one probed goes unnoticed with
+        probability (1-p)^(n_probes-1), and gets frozen into the tables.
+        Raise n_probes for environments with rare outcomes, or only
+        compile transitions known to be deterministic.
+
+        Probes are checked as transitions are while validating, but do
+        not count towards validate.
+        '''
+        self._table, self._steps = None, None
+        S, A = self.states.N, self.actions.N
+        s, a = np.divmod(np.arange(S*A), A)
+
+        n_validate = self._n_validate
+        try:
+            (s_0, r_0), end_0 = self._vec_transition(s, a)
+            for _ in range(n_probes - 1):
+                self._n_validate = n_validate
+                (s_i, r_i), end_i = self._vec_transition(s, a)
+                if not (np.array_equal(s_0, s_i) and np.array_equal(r_0, r_i)
+                    and np.array_equal(end_0, end_i)):
+                    if strict:
+                        raise TransitionException(
+                            "Transition method is stochastic, it can not be"
+                            " compiled")
+                    return False
+        finally:
+            self._n_validate = n_validate
+
+        self._table = (s_0.reshape(S, A), r_0.reshape(S, A), 
+            end_0.reshape(S, A))
+        # (next state, reward, end) per s·A + a, for scalar stepping
+        self._steps = list(zip(s_0.tolist(), r_0.tolist(), end_0.tolist()))
+        return True
+
+    def estimate_model(self, k: int = 100, cache: str = None
+        ) -> EmpiricalModel:
+        '''
+        Samples the transition k times for every (s,a) and returns the
+        resulting EmpiricalModel. If cache is the path of a .npz model
+        saved from the same environment, states, actions, transition and
+        gamma, with the same k, it is loaded instead. Otherwise the model
+        is estimated and saved there.
+        '''
+        if not isinstance(k, int):
+            raise TypeError(f"k must be an int, not {type(k)}")
+        _check_ranges(values=[k], ranges=[(1, np.inf)])
+
+        S, A = self.states.N, self.actions.N
+        env = self._fingerprint()
+        if cache and not cache.endswith('.npz'):
+            cache += '.npz'
+        if cache and os.path.exists(cache):
+            model = EmpiricalModel.load(cache)
+            if (model.S, model.A, model.k, model.gamma, model.env) == \
+                (S, A, k, self.gamma, env):
+                return model
+
+        sa = np.repeat(np.arange(S*A), k)
+        (next_s, r), end = self._vec_transition(sa // A, sa % A)
+        next_s = np.where(end, S, next_s)
+
+        codes, counts = np.unique(sa*(S+1) + next_s, return_counts=True)
+        r_sa = np.bincount(sa, r, minlength=S*A).reshape(S, A) / k
+        model = EmpiricalModel(S, A, (codes // (S+1)).astype(np.int32),
+            (codes % (S+1)).astype(np.int32), counts.astype(np.int32),
+            r_sa, k, self.gamma, env)
+
+        if cache:
+            model.save(cache)
+
+        return model
+
+    def _fingerprint(self) -> str:
+        '''
+        Digest of the states, actions and transition code, to tell apart
+        models estimated from different environments
+        '''
+        code = self.transition.__code__
+        states = self.states.dims if isinstance(self.states, 
+            MixedRadixState) else list(self.states.seq)
+        h = hashlib.sha1()
+        for part in (self.transition.__qualname__, code.co_code, 
+            code.co_consts, states, list(self.actions.seq)):
+            h.update(repr(part).encode())
+        return h.hexdigest()
+
     def random_sa(self, value=False):
         s = self.states.random(value)
         a = self.actions.random(value)
@@ -112,9 +652,24 @@ class ModelFree:
 
         return state, action
 
+    def _validating(self) -> bool:
+        if self._n_validate is None:
+            return True
+        if self._n_validate <= 0:
+            return False
+        self._n_validate -= 1
+        return True
+
     def _transition(self, state: Any, action: Any,
-        ) -> Tuple[Tuple[Any, Union[float, int]], bool]:
-        
+        ) -> Tuple[Tuple[Any, int, Union[float, int]], bool]:
+        '''
+        Calls the transition on state and action, already known to be
+        declared, and also returns the index of the new state.
+        '''
+        if not self._validating():
+            (s, r), end = self.transition(state, action)
+            return (s, self.states.get_index(s), r), end
+
         # to help debug ill defined transitions
         try:
             (s, r), end = self.transition(state, action)
@@ -127,39 +682,190 @@ class ModelFree:
                 f" instead of ({type(s)}, {type(r)}), {type(end)}"
                 )  
         try:
-            self.states.get_index(s)
-            self.states.get_index(state)
-            self.actions.get_index(action)
+            s_idx = self.states.get_index(s)
         except Exception as e:
             raise TransitionException(
                 f"Undeclared state or action in transition method: {e}")
 
-        return (s, r), end
+        return (s, s_idx, r), end
 
-    def generate_episode(self, s_0: Any, a_0: Any, max_steps: int=MAX_STEPS,  
-        policy: ModelFreePolicy = None) -> List[EpisodeStep]:
+    def _vec_transition(self, states: np.ndarray, actions: np.ndarray
+        ) -> Tuple[Tuple[np.ndarray, np.ndarray], np.ndarray]:
+        
+        if self.compiled:
+            next_s, r, end = self._table
+            return (next_s[states, actions], r[states, actions]), \
+                end[states, actions]
+
+        if not self.vectorized:
+            steps = [self.step_transition(s, a) for s, a in zip(states, actions)]
+            s = np.array([s for (s, _), _ in steps], dtype=int)
+            r = np.array([r for (_, r), _ in steps], dtype=float)
+            end = np.array([end for _, end in steps], dtype=bool)
+            return (s, r), end
 
+        if not self._validating():
+            (s, r), end = self.transition(states, actions)
+            return (s, r), end
+
+        try:
+            (s, r), end = self.transition(states, actions)
+        except Exception as e:
+            raise TransitionException(f"Transition method failed: {e}")
+
+        s, r, end = np.asarray(s), np.asarray(r), np.asarray(end)
+        if not (s.shape == r.shape == end.shape == states.shape):
+            raise TransitionException(
+                "Vectorized transition method must return arrays shaped as"
+                f" its inputs {states.shape}, instead of ({s.shape},"
+                f" {r.shape}), {end.shape}")
+        if end.dtype != bool or not np.issubdtype(s.dtype, np.integer):
+            raise TransitionException(
+                "Vectorized transition method must return (int, float), bool"
+                f" arrays instead of ({s.dtype}, {r.dtype}), {end.dtype}")
+        if s.size and (s.min() < 0 or s.max() >= self.states.N):
+            raise TransitionException(
+                "Undeclared state index in vectorized transition method")
+
+        return (s, r.astype(float)), end
+
+    def generate_episode(self, s_0: Any, a_0: Any, max_steps: int=MAX_STEPS,  
+        policy: ModelFreePolicy = None, buffer: EpisodeBuffer = None
+        ) -> Union[List[EpisodeStep], EpisodeBuffer]:
+        '''
+        Generates an episode from the state and action values s_0, a_0 as
+        a list of (s, a, r) steps. If buffer is given, it is reset and the
+        episode written into it instead, avoiding the list and the later
+        conversion to arrays.
+        '''
         policy = policy if policy else self.policy
 
-        episode = []
+        if self.compiled:
+            s_0, a_0 = self._to_index(s_0, a_0)
+            return self._compiled_episode(s_0, a_0, max_steps, policy, buffer)
+
+        if self.vectorized:
+            s_0, a_0 = self._to_index(s_0, a_0)
+            s, a, r = self.generate_episodes([s_0], [a_0], max_steps, policy)[0]
+            if buffer is not None:
+                buffer.reset()
+                buffer.extend(s, a, r)
+                return buffer
+            return [(int(s_t), int(a_t), r_t) for s_t, a_t, r_t in zip(s, a, r)]
+
+        try:
+            _s, _a = self._to_index(s_0, a_0)
+        except Exception as e:
+            raise TransitionException(
+                f"Undeclared state or action in transition method: {e}")
+
+        episode = [] if buffer is None else buffer
+        if buffer is not None:
+            buffer.reset()
+
         end = False
         step = 0
         s_t_1, a_t_1 = s_0, a_0
         while (end != True) and (step < max_steps):
-            (s_t, r_t), end = self._transition(s_t_1, a_t_1)
-            (_s, _a), _r = self._to_index(s_t_1, a_t_1), r_t
-            episode.append((_s, _a, _r))
-            a_t = policy(self.states.get_index(s_t))
-            s_t_1, a_t_1 = s_t, self.actions.from_index(a_t)
+            (s_t, s_t_idx, r_t), end = self._transition(s_t_1, a_t_1)
+            episode.append((_s, _a, r_t))
+            _s, _a = s_t_idx, policy(s_t_idx)
+            s_t_1, a_t_1 = s_t, self.actions.from_index(_a)
             
             step += 1
 
+        if self.store is not None:
+            s, a, r = ((buffer.s, buffer.a, buffer.r) if buffer is not None
+                else (np.array(x) for x in zip(*episode)))
+            self.store.append(s, a, r, policy.pi_as(a, s))
+
+        return episode
+
+    def _compiled_episode(self, s: int, a: int, max_steps: int,
+        policy: ModelFreePolicy, buffer: EpisodeBuffer = None
+        ) -> Union[List[EpisodeStep], EpisodeBuffer]:
+        '''
+        generate_episode over the compiled tables, from state and action
+        indexes: a list lookup and a policy call per step.
+        '''
+        steps, A = self._steps, self.actions.N
+        episode = [] if buffer is None else buffer
+        if buffer is not None:
+            buffer.reset()
+
+        end = False
+        step = 0
+        while not end and step < max_steps:
+            s_t, r_t, end = steps[s*A + a]
+            episode.append((s, a, r_t))
+            s, a = s_t, policy(s_t)
+            step += 1
+
+        if self.store is not None:
+            s, a, r = ((buffer.s, buffer.a, buffer.r) if buffer is not None
+                else (np.array(x) for x in zip(*episode)))
+            self.store.append(s, a, r, policy.pi_as(a, s))
+
         return episode
 
+    def generate_episodes(self, s_0: Sequence[int], a_0: Sequence[int],
+        max_steps: int=MAX_STEPS, policy: ModelFreePolicy = None
+        ) -> List[Episode]:
+        '''
+        Advances len(s_0) episodes in lockstep, starting from the state
+        and action indexes s_0 and a_0. Each step makes a single call to
+        a vectorized transition over all the unfinished episodes, and a
+        single batched policy sample.
+
+        Returns an (s, a, r) tuple of int32, int32 and float64 arrays per
+        episode, views of step major buffers grown geometrically.
+        '''
+        policy = policy if policy else self.policy
+
+        n, max_steps = len(s_0), int(max_steps)
+        size = min(max_steps, 64)
+        S = np.zeros((size, n), dtype=np.int32)
+        A = np.zeros((size, n), dtype=np.int32)
+        R = np.zeros((size, n))
+        T = np.full(n, max_steps)
+
+        active = np.arange(n)
+        s_t, a_t = np.asarray(s_0, dtype=int), np.asarray(a_0, dtype=int)
+        step = 0
+        while active.size and step < max_steps:
+            if step == size:
+                size = min(2*size, max_steps)
+                S, A, R = (np.concatenate([X, np.zeros_like(X)])[:size] 
+                    for X in (S, A, R))
+
+            (s_n, r_t), end = self._vec_transition(s_t, a_t)
+            S[step, active], A[step, active], R[step, active] = s_t, a_t, r_t
+            step += 1
+
+            T[active[end]] = step
+            active, s_t = active[~end], s_n[~end]
+            a_t = policy.sample(s_t)
+
+        episodes = [(S[:t, i], A[:t, i], R[:t, i]) for i, t in enumerate(T)]
+        if self.store is not None:
+            for s, a, r in episodes:
+                self.store.append(s, a, r, policy.pi_as(a, s))
+
+        return episodes
+
     def step_transition(self, state: int, action: int
     ) -> Tuple[Tuple[int, float], bool]:
     
+        if self.compiled:
+            next_s, r, end = self._table
+            return (int(next_s[state, action]), float(r[state, action])), \
+                bool(end[state, action])
+
+        if self.vectorized:
+            (s, r), end = self._vec_transition(
+                np.array([state]), np.array([action]))
+            return (int(s[0]), float(r[0])), bool(end[0])
+
         s, a = self.states.from_index(state), self.actions.from_index(action)
-        (s_t, r_t), end = self._transition(s, a)
-        s_new = self.states.get_index(s_t)
-        return (s_new, r_t), end
\ No newline at end of file
+        (_, s_new, r_t), end = self._transition(s, a)
+        return (s_new, r_t), end
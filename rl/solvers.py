@@ -2,17 +2,30 @@
 RL - Copyright © 2023 Iván Belenky @Leculette
 """
 
+import random
+from collections import defaultdict
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 from typing import (
     Tuple, 
+    Union,
     Sequence,  
     Any
 )
 
 import numpy as np
 from numpy.linalg import norm as lnorm
+try:
+    import scipy.sparse as sparse
+    from scipy.sparse.linalg import spsolve
+except ImportError:
+    sparse = None
 
 from rl.model_free import (
     ModelFree,
+    EpisodeBuffer,
+    EpisodeStore,
+    Episode,
     ModelFreePolicy,
     EpsilonSoftPolicy
 )
@@ -33,14 +46,59 @@ from rl.utils import (
 ) 
 
 
-def get_sample(MF, v, q, π, n_episode, optimize):
-    _idx = n_episode
-    _v, _q = Vpi(v.copy(), MF.states), Qpi(q.copy(), MF.stateaction)
-    _pi = None
-    if optimize:
-        _pi = ModelFreePolicy(MF.actions.N, MF.states.N)
-        _pi.pi = π.pi.copy()
-    return (_idx, _v, _q, _pi)
+WORKER_EPISODES = 100 # episodes per worker task and round
+VEC_MIN_STEPS = 32 # shorter episodes are cheaper to walk step by step
+SWEEP_BLOCK = 64 # default states backed up at once by in place sweeps
+OPE_CHUNK = 2**22 # policy steps held at once by off_policy_eval
+
+
+class _Snapshots:
+    '''
+    Storage for the n_samples samples of a solver run. v, q and π.pi are
+    copied as float32 into arrays preallocated once for all of them, and
+    each sample is a set of views over its slot, so taking one allocates
+    no arrays.
+    '''
+    def __init__(self, MF: ModelFree, optimize: bool, n_samples: int):
+        S, A, n = MF.states.N, MF.actions.N, int(n_samples)
+        self.MF = MF
+        self.optimize = optimize
+        self._v = np.empty((n, S), dtype=np.float32)
+        self._q = np.empty((n, S, A), dtype=np.float32)
+        self._pi = np.empty((n, S, A), dtype=np.float32) if optimize else None
+        self._i = 0
+
+    def take(self, v, q, π, n_episode) -> Tuple[int, Vpi, Qpi, Policy]:
+        i = self._i
+        if i == self._v.shape[0]:
+            raise IndexError("more samples taken than preallocated")
+        self._i += 1
+
+        self._v[i], self._q[i] = v, q
+        _v = Vpi(self._v[i], self.MF.states)
+        _q = Qpi(self._q[i], self.MF.states)
+        _pi = None
+        if self.optimize:
+            self._pi[i] = π.pi
+            _pi = ModelFreePolicy(self.MF.actions.N, self.MF.states.N,
+                pi=self._pi[i])
+        return (n_episode, _v, _q, _pi)
+
+
+def _n_samples(n_episodes, sample_step, first=1):
+    '''
+    Samples taken when counting episodes from first, one every sample_step
+    '''
+    if not sample_step:
+        return 0
+    last = int(n_episodes) - 1 + first
+    return last // sample_step - (first - 1) // sample_step
+
+
+def get_sample(MF, v, q, π, n_episode, optimize, snapshots=None):
+    if snapshots is None:
+        snapshots = _Snapshots(MF, optimize, 1)
+    return snapshots.take(v, q, π, n_episode)
 
 
 def _set_s0_a0(MF, s_0, a_0):
@@ -52,6 +110,90 @@ def _set_s0_a0(MF, s_0, a_0):
     return s_0, a_0
 
 
+def _episodes(MF, π, n_episodes, max_steps, n_envs=1, s_0=None, a_0=None,
+    n_workers=1, replay=None):
+    '''
+    Yields n_episodes episodes as (s, a, r) tuples of int32, int32 and
+    float64 arrays, views only valid until the next episode is drawn. A
+    None s_0 or a_0 is drawn at random for each episode. With n_envs > 1
+    the episodes are simulated n_envs at a time in lockstep with the
+    policy as it was when the batch started. With n_workers > 1 they are
+    simulated in a process pool, see _parallel_episodes. If replay is an
+    EpisodeStore, its first n_episodes episodes are yielded instead and
+    nothing is simulated.
+    '''
+    if replay is not None:
+        yield from islice(replay, int(n_episodes))
+        return
+
+    if n_workers > 1:
+        yield from _parallel_episodes(MF, π, n_episodes, max_steps, n_envs,
+            s_0, a_0, n_workers)
+        return
+
+    buffer = EpisodeBuffer()
+    n_episode = 0
+    while n_episode < n_episodes:
+        if n_envs == 1 and (MF.compiled or not MF.vectorized):
+            s = s_0 if s_0 is not None else MF.states.random(value=True)
+            a = a_0 if a_0 is not None else MF.actions.random(value=True)
+            MF.generate_episode(s, a, max_steps, policy=π, buffer=buffer)
+            yield buffer.s, buffer.a, buffer.r
+            n_episode += 1
+            continue
+
+        n = int(min(n_envs, n_episodes - n_episode))
+        s = (np.full(n, MF.states.get_index(s_0)) if s_0 is not None 
+            else np.random.randint(MF.states.N, size=n))
+        a = (np.full(n, MF.actions.get_index(a_0)) if a_0 is not None 
+            else np.random.randint(MF.actions.N, size=n))
+        yield from MF.generate_episodes(s, a, max_steps, π)
+        n_episode += n
+
+
+_WORKER_MF = None
+
+
+def _init_worker(MF):
+    global _WORKER_MF
+    _WORKER_MF = MF
+
+
+def _worker_episodes(π, seed, n_episodes, max_steps, n_envs, s_0, a_0):
+    np.random.seed(seed)
+    random.seed(seed)
+    return [(s.copy(), a.copy(), r.copy()) for s, a, r in 
+        _episodes(_WORKER_MF, π, n_episodes, max_steps, n_envs, s_0, a_0)]
+
+
+def _parallel_episodes(MF, π, n_episodes, max_steps, n_envs, s_0, a_0,
+    n_workers):
+    '''
+    Each round, every worker gets a snapshot of π and a seed drawn from
+    numpy's global RNG, and simulates max(n_envs, WORKER_EPISODES)
+    episodes. Episodes are yielded in submission order as the workers
+    finish, so runs are reproducible under np.random.seed. The model is
+    sent once per worker, hence the transition must be picklable.
+    '''
+    chunk = max(n_envs, WORKER_EPISODES)
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker, 
+        initargs=(MF,)) as pool:
+        n_episode = 0
+        while n_episode < n_episodes:
+            futures = []
+            for _ in range(n_workers):
+                n = int(min(chunk, n_episodes - n_episode))
+                if n <= 0:
+                    break
+                seed = np.random.randint(2**32)
+                futures.append(pool.submit(_worker_episodes, π, seed, n,
+                    max_steps, n_envs, s_0, a_0))
+                n_episode += n
+
+            for future in futures:
+                yield from future.result()
+
+
 def _set_policy(policy, eps, actions, states):
     if not policy and eps:
         _typecheck_all(constants=[eps])
@@ -64,89 +206,224 @@ def _set_policy(policy, eps, actions, states):
     
 
 def vq_π_iter_naive(MDP, policy: Policy, tol: float = TOL,
-    max_iters: int = MAX_ITER) -> np.ndarray:
+    max_iters: int = MAX_ITER, v_0: np.ndarray = None) -> np.ndarray:
+    '''Iterative policy evaluation
 
+    Each sweep is a row-wise contraction over (s,a), so it costs
+    O(S·A) on top of the Σ_s' p(s'|s,a)v(s') product, which is O(nnz)
+    for sparse models. No SxS intermediates are built. v_0 warm starts
+    the sweeps, by default zeros.
+    '''
     γ = MDP.gamma
-    p_s = MDP.p_s
 
-    vᵢ = np.ones(MDP.S)
+    vᵢ = np.zeros(MDP.S) if v_0 is None else v_0
     diff_norm = TOL*2
 
     π_sa = np.array([policy.π(s) for s in range(MDP.S)]) #SxA
-    r_sa  = np.array([[MDP.r_sa(s,a) for s in range(MDP.S)]   
-        for a in range(MDP.A)]) #AxS
+    r_sa = MDP.r_sa_matrix().T #AxS
+    r_π = np.einsum('sa,as->s', π_sa, r_sa)
 
     n_iter = 0
     while (n_iter < max_iters) and (diff_norm > tol):
-        vᵢ_1 = vᵢ.copy()
-        
-        vᵢ = np.diag(π_sa @ r_sa)
-        vᵢ = vᵢ + γ * np.diag((p_s @ vᵢ_1) @ π_sa.T)
+        vᵢ_1 = vᵢ
+        vᵢ = r_π + γ * np.einsum('sa,sa->s', π_sa, MDP.p_sv(vᵢ_1))
 
         diff_norm = lnorm(vᵢ - vᵢ_1)
         n_iter += 1
     
     vπ = vᵢ
-    qπ = r_sa + (p_s @ vπ).T
+    qπ = r_sa + γ * MDP.p_sv(vπ).T
+
+    return vπ, qπ
+
+
+def vq_π_linear(MDP, policy: Policy, tol: float = TOL,
+    max_iters: int = MAX_ITER) -> np.ndarray:
+    '''Exact policy evaluation
+
+    Solves the Bellman expectation equation (I - γP_π)v = r_π directly,
+    using a sparse LU factorization for sparse models. Suited for small
+    and medium sized state spaces; tol and max_iters are accepted only
+    to share the signature of the iterative solvers. The system is
+    singular for γ = 1 on non terminating chains.
+    '''
+    γ = MDP.gamma
+
+    π_sa = np.array([policy.π(s) for s in range(MDP.S)]) #SxA
+    r_sa = MDP.r_sa_matrix().T #AxS
+    r_π = np.einsum('sa,as->s', π_sa, r_sa)
+
+    p_π = MDP.p_pi(π_sa)
+    if MDP.sparse:
+        I = sparse.identity(MDP.S, format='csc')
+        vπ = spsolve((I - γ*p_π).tocsc(), r_π)
+    else:
+        vπ = np.linalg.solve(np.eye(MDP.S) - γ*p_π, r_π)
+
+    qπ = r_sa + γ * MDP.p_sv(vπ).T
 
     return vπ, qπ
 
 
 def policy_iteration(MDP, policy: Policy, tol_eval: float = TOL,
     max_iters_eval: int = MAX_ITER, tol_opt: float = TOL,
-    max_iters_opt: int = MAX_ITER) -> np.ndarray:
+    max_iters_opt: int = MAX_ITER, k: int = None) -> np.ndarray:
+    '''Policy iteration
+
+    Alternates evaluation and greedy improvement until the greedy policy
+    is stable or v changes less than tol_opt between improvements.
+
+    Setting k runs modified policy iteration: each evaluation is at most
+    k sweeps, warm started from the previous v. Once the greedy policy
+    is stable, a full evaluation confirms it before stopping.
 
-    vᵢ_1, q_i_1 = vq_π_iter_naive(MDP, policy, tol_eval, max_iters_eval)
-    vᵢ, q_i = vᵢ_1.copy(), q_i_1.copy()
+    Returns v, q and the number of improvements run.
+    '''
+    partial = int(k) if k else max_iters_eval
+    n_sweeps = partial
+
+    vᵢ, q_i = vq_π_iter_naive(MDP, policy, tol_eval, n_sweeps)
 
     diff_norm = 2*tol_opt
 
     n_iter = 0
     while (n_iter < max_iters_opt) and (diff_norm > tol_opt):
-        vᵢ_1 = vᵢ.copy()
-        q_i_1 = q_i.copy()
+        vᵢ_1 = vᵢ
+        pi_sa = policy.pi_sa.copy()
+
+        policy.update_policy(q_i)
+        stable = np.array_equal(pi_sa, policy.pi_sa)
+        if stable and n_sweeps == max_iters_eval:
+            break
 
-        policy.update_policy(q_i_1)
-        vᵢ, q_i = vq_π_iter_naive(MDP, policy, tol_eval, max_iters_eval)
+        n_sweeps = max_iters_eval if stable else partial
+        vᵢ, q_i = vq_π_iter_naive(MDP, policy, tol_eval, n_sweeps, v_0=vᵢ_1)
         
         n_iter += 1 
         diff_norm = lnorm(vᵢ - vᵢ_1)
     
-    return vᵢ, q_i
+    return vᵢ, q_i, n_iter
     
 
+def _sweep_in_place(MDP, r_sa, vᵢ, blocks):
+    '''
+    in place Bellman optimality backups, one block of states at a time:
+    each block is backed up at once from the values left by the previous
+    blocks
+    '''
+    γ, A = MDP.gamma, MDP.A
+    for b, p_b in blocks:
+        vᵢ[b] = np.max(r_sa[:,b] + γ * (p_b @ vᵢ).reshape(-1, A).T, axis=0)
+
+
+def _sweep_blocks(MDP, block):
+    # contiguous blocks of states along with their rows of p(s'|s,a)
+    return [(b, MDP.p_rows(b)) for b in 
+        (slice(i, min(i + block, MDP.S)) for i in range(0, MDP.S, block))]
+
+
+def _vi_jacobi(MDP, r_sa, vᵢ, tol, blocks):
+    return np.max(r_sa + MDP.gamma * MDP.p_sv(vᵢ).T, axis=0)
+
+
+def _vi_gauss_seidel(MDP, r_sa, vᵢ, tol, blocks):
+    vᵢ = vᵢ.copy()
+    _sweep_in_place(MDP, r_sa, vᵢ, blocks)
+    return vᵢ
+
+
+def _vi_async(MDP, r_sa, vᵢ, tol, blocks):
+    vᵢ = vᵢ.copy()
+    _sweep_in_place(MDP, r_sa, vᵢ, 
+        [blocks[i] for i in np.random.permutation(len(blocks))])
+    return vᵢ
+
+
+def _vi_prioritized(MDP, r_sa, vᵢ, tol, blocks):
+    # only blocks with a Bellman residual above tol are backed up, the
+    # largest residuals first. The residuals come from a full jacobi
+    # backup, so a sweep costs up to about two jacobi ones
+    residual = np.abs(np.max(r_sa + MDP.gamma * MDP.p_sv(vᵢ).T, axis=0) - vᵢ)
+    r_max = np.array([residual[b].max() for b, _ in blocks])
+    order = np.argsort(-r_max)
+    vᵢ = vᵢ.copy()
+    _sweep_in_place(MDP, r_sa, vᵢ, [blocks[i] for i in order if r_max[i] > tol])
+    return vᵢ
+
+
+SWEEP_MAP = {
+    'jacobi': _vi_jacobi,
+    'gauss_seidel': _vi_gauss_seidel,
+    'async': _vi_async,
+    'prioritized': _vi_prioritized,
+}
+
+
 def value_iteration(MDP, policy: Policy = None, tol: float = TOL,
-    max_iters: int = MAX_ITER) -> np.ndarray:
+    max_iters: int = MAX_ITER, sweep: str = 'jacobi', 
+    block: int = SWEEP_BLOCK) -> np.ndarray:
+    '''Value iteration
+
+    sweep selects how each iteration backs up the states:
+        jacobi: synchronous, vectorized update from the previous v.
+        gauss_seidel: in place, blocks of states in index order.
+        async: in place, blocks in a random order each sweep.
+        prioritized: in place, only the blocks with a Bellman residual
+            above tol, largest residual first.
+    
+    In place sweeps back up block states at a time, each block from the
+    freshest values of the previous ones. Within a block the update is
+    synchronous, as in jacobi, so the order only applies across blocks:
+    with S <= block they are plain jacobi sweeps, and block=1 gives true
+    per state Gauss-Seidel. They can take fewer sweeps to reach tol but
+    trade wall time for it: a block backup costs about as much as a
+    jacobi one over its rows plus a per block overhead, larger the
+    smaller the blocks, and prioritized also computes a full jacobi
+    residual each sweep. jacobi is the fastest in wall time and stays
+    the default.
+
+    Returns v, q and the number of sweeps run.
+    '''
+    if sweep not in SWEEP_MAP:
+        raise ValueError(
+            f'Unknown sweep {sweep}\n'
+            'Available sweeps are (jacobi, gauss_seidel, async, prioritized)')
+    _typecheck_all(constants=[block])
+    _check_ranges(values=[block], ranges=[(1, np.inf)])
 
     policy = policy if policy else MDP.policy
+    f_sweep = SWEEP_MAP[sweep]
 
     γ = MDP.gamma
-    p_s = MDP.p_s
 
-    vᵢ = np.ones(MDP.S)
+    vᵢ = np.zeros(MDP.S)
     diff_norm = TOL*2
     
-    r_sa  = np.array([[MDP.r_sa(s,a) for s in range(MDP.S)]   
-        for a in range(MDP.A)]) #AxS
+    r_sa = MDP.r_sa_matrix().T #AxS
+
+    blocks = _sweep_blocks(MDP, int(block)) if sweep != 'jacobi' else None
 
     n_iter = 0
     while (n_iter < max_iters) and (diff_norm > tol):
-        vᵢ_1 = vᵢ.copy()
-        
-        qᵢ = r_sa + γ * (p_s @ vᵢ_1).T
-        vᵢ = np.array([np.max(qᵢ[:,s]) for s in range(MDP.S)])
+        vᵢ_1 = vᵢ
+        vᵢ = f_sweep(MDP, r_sa, vᵢ_1, tol, blocks)
 
         diff_norm = lnorm(vᵢ - vᵢ_1)
         n_iter += 1
 
+    qᵢ = r_sa + γ * MDP.p_sv(vᵢ).T
     policy.update_policy(qᵢ)
 
+    return vᵢ, qᵢ, n_iter
+
 
 def alpha_mc(states: Sequence[Any], actions: Sequence[Any], transition: Transition,
     gamma: float=0.9, alpha: float=0.05, use_N :bool=False, first_visit: bool=True,
     exploring_starts: bool=True, n_episodes: int=MAX_ITER, max_steps: int=MAX_STEPS,
     samples: int=1000, optimize: bool=False, policy: ModelFreePolicy=None, 
-    eps: float=None) -> Tuple[VQPi, Samples]:
+    eps: float=None, n_envs: int=1, vectorized: bool=False,
+    deterministic: bool=False, validate: int=None, n_workers: int=1,
+    replay: EpisodeStore=None) -> Tuple[VQPi, Samples]:
     '''α-MC state and action-value function estimation, policy optimization
 
     Alpha weighted Monte Carlo state and action-value function estimation, policy
@@ -182,6 +459,26 @@ def alpha_mc(states: Sequence[Any], actions: Sequence[Any], transition: Transiti
         Policy to use, by default equal probability ModelFreePolicy
     eps : float, optional
         Epsilon for the EpsilonSoftPolicy, by default None (no exploration)
+    n_envs : int, optional
+        Number of episodes simulated in lockstep per batch, by default 1
+    vectorized : bool, optional
+        If true, transition takes and returns index arrays as described in
+        ModelFree, by default False
+    deterministic : bool, optional
+        If true, the transition is probed for every (s,a) and compiled into
+        lookup tables, see ModelFree.compile_transitions. Stochastic
+        transitions raise a TransitionException, by default False
+    validate : int, optional
+        Number of transitions checked strictly, the rest skip the checks,
+        by default None (all of them)
+    n_workers : int, optional
+        Number of processes generating episodes, by default 1. Each round
+        they get a snapshot of the policy and their own seed, the
+        transition must be picklable.
+    replay : EpisodeStore, optional
+        Recorded episodes to learn from instead of simulating them, the
+        first n_episodes are used. Optimizing then changes the estimates
+        but not the episodes, by default None
 
     Returns
     -------
@@ -203,90 +500,134 @@ def alpha_mc(states: Sequence[Any], actions: Sequence[Any], transition: Transiti
         policy = ModelFreePolicy(actions, states)
 
     _typecheck_all(tabular_idxs=[states, actions],transition=transition,
-        constants=[gamma, alpha, n_episodes, max_steps, samples],
-        booleans=[use_N, first_visit, exploring_starts, optimize],
+        constants=[gamma, alpha, n_episodes, max_steps, samples, n_envs,
+            n_workers],
+        booleans=[use_N, first_visit, exploring_starts, optimize, vectorized,
+            deterministic],
         policies=[policy])
 
-    _check_ranges(values=[gamma, alpha, n_episodes, max_steps, samples],
-        ranges=[(0,1), (0,1), (1,np.inf), (1,np.inf), (1,1001)])
+    _check_ranges(values=[gamma, alpha, n_episodes, max_steps, samples, n_envs,
+        n_workers], ranges=[(0,1), (0,1), (1,np.inf), (1,np.inf), (1,1001),
+        (1,np.inf), (1,np.inf)])
 
         
     sample_step = _get_sample_step(samples, n_episodes)
 
-    model = ModelFree(states, actions, transition, gamma=gamma, policy=policy)    
+    model = ModelFree(states, actions, transition, gamma=gamma, policy=policy,
+        vectorized=vectorized, deterministic=deterministic, validate=validate)    
     v, q, samples = _visit_monte_carlo(model, first_visit, exploring_starts, use_N,
-        alpha, n_episodes, max_steps, optimize, sample_step) 
+        alpha, n_episodes, max_steps, optimize, sample_step, n_envs, n_workers,
+        replay)
 
     return VQPi((v, q, model.policy.pi)), samples
 
 
-def _mc_step(v, q, t, s_t, a_t, s, a, n_s, n_sa, G, first_visit):
-    if s_t not in s[:-(t+1)] or not first_visit:
-        n_s[s_t] = n_s[s_t] + 1
-        v[s_t] = v[s_t] + (G - v[s_t])/n_s[s_t]
-    
-    q_key = (s_t, a_t)
-    if q_key not in zip(s[:-(t+1)],a[:-(t+1)]) or not first_visit:    
-        n_sa[q_key] = n_sa[q_key] + 1
-        q[q_key] = q[q_key] + (G - q[q_key])/n_sa[q_key]
-        return True
-    
-    return False
+def _returns(r, γ):
+    '''
+    G_t = r_t+1 + γG_t+1 for every step t of the episode, as a reverse
+    discounted cumulative sum. It runs over blocks short enough for the
+    discount powers not to underflow, carrying G across blocks.
+    '''
+    if γ == 1:
+        return np.cumsum(r[::-1])[::-1]
+    if γ == 0:
+        return r.astype(float)
+
+    T = r.shape[0]
+    B = max(1, int(np.log(1E-100)/np.log(γ)))
+    G, g = np.empty(T), 0.
+    for end in range(T, 0, -B):
+        start = max(0, end - B)
+        k = np.arange(end - start)
+        γ_k = γ**k
+        G[start:end] = np.cumsum((γ_k * r[start:end])[::-1])[::-1] / γ_k \
+            + g * γ**(end - start - k)
+        g = G[start]
+    return G
+
+
+def _first_visits(s, a, n_actions):
+    '''
+    Masks of the steps that are the first visit of s_t and of (s_t, a_t)
+    within the episode, O(T log T) instead of a scan per step.
+    '''
+    first_s = np.zeros(s.shape[0], dtype=bool)
+    first_sa = np.zeros(s.shape[0], dtype=bool)
+    first_s[np.unique(s, return_index=True)[1]] = True
+    first_sa[np.unique(s*n_actions + a, return_index=True)[1]] = True
+    return first_s, first_sa
 
 
-def _mc_step_α(v, q, t, s_t, a_t, s, a, α, G, first_visit):
-    if s_t not in s[:-(t+1)] or not first_visit:
-        v[s_t] = v[s_t] + α*(G - v[s_t])
-    
-    q_key = (s_t, a_t)
-    if q_key not in zip(s[:-(t+1)],a[:-(t+1)]) or not first_visit:    
-        q[q_key] = q[q_key] + α*(G - q[q_key])
-        return True
-    
-    return False
+def _mc_step(x, key, G, n_x):
+    '''
+    1/N running average of the returns G into the flat table x at key,
+    keys may repeat. Averaging incrementally k returns is the same as
+    adding their sum at once, so visits are accumulated per key.
+    '''
+    keys, inv, n_k = np.unique(key, return_inverse=True, return_counts=True)
+    G_k = np.bincount(inv, G, minlength=keys.shape[0])
+    n = n_x[keys] + n_k
+    x[keys] = x[keys] + (G_k - n_k*x[keys])/n
+    n_x[keys] = n
+
+
+def _mc_step_α(x, key, G, α):
+    '''
+    α weighted update of the returns G into the flat table x at key, keys
+    may repeat and are applied in order. A visit followed by m updates
+    of the same key ends up weighted α(1-α)^m.
+    '''
+    keys, inv, n_k = np.unique(key, return_inverse=True, return_counts=True)
+    rank = np.empty_like(inv)
+    rank[np.argsort(inv, kind='stable')] = \
+        np.arange(inv.shape[0]) - np.repeat(np.cumsum(n_k) - n_k, n_k)
+    m = n_k[inv] - 1 - rank
+    x[keys] = (1-α)**n_k * x[keys] + \
+        np.bincount(inv, α*(1-α)**m * G, minlength=keys.shape[0])
 
 
 def _visit_monte_carlo(MF, first_visit, exploring_starts, use_N, alpha, 
-    n_episodes, max_steps, optimize, sample_step):
+    n_episodes, max_steps, optimize, sample_step, n_envs=1, n_workers=1,
+    replay=None):
     
     π = MF.policy
     γ = MF.gamma
     α = alpha
 
     samples = []
+    snapshots = _Snapshots(MF, optimize,
+        _n_samples(n_episodes, sample_step))
 
     v, q = np.zeros(MF.states.N), np.zeros((MF.states.N, MF.actions.N))
     if use_N:
         n_s, n_sa = np.zeros(MF.states.N), np.zeros((MF.states.N, MF.actions.N))
+        f_step, v_arg, q_arg = _mc_step, n_s, n_sa.reshape(-1)
+    else:
+        f_step, v_arg, q_arg = _mc_step_α, α, α
+
+    s_0, a_0 = (None, None) if exploring_starts else MF.random_sa(value=True)
+
+    q_flat = q.reshape(-1)
+    episodes = _episodes(MF, π, n_episodes, max_steps, n_envs, s_0, a_0,
+        n_workers, replay)
+    for n_episode, (s, a, r) in enumerate(episodes, 1):
+        G = _returns(r, γ)
+        sa = s*MF.actions.N + a
+        
+        mask_s = mask_sa = np.ones(s.shape[0], dtype=bool)
+        if first_visit:
+            mask_s, mask_sa = _first_visits(s, a, MF.actions.N)
 
-    s_0, a_0 = MF.random_sa(value=True)
-
-    n_episode = 0
-    while n_episode < n_episodes:
-        if exploring_starts:
-            s_0, a_0 = MF.random_sa(value=True)
+        # visits are applied backwards in time, as returns are found
+        f_step(v, s[mask_s][::-1], G[mask_s][::-1], v_arg)
+        f_step(q_flat, sa[mask_sa][::-1], G[mask_sa][::-1], q_arg)
 
-        episode = MF.generate_episode(s_0, a_0, π, max_steps)
-        sar = np.array(episode)
-        s, a, _ = sar.T
-        
-        G = 0   
-        for t, (s_t, a_t, r_tt) in enumerate(sar[::-1]):
-            s_t, a_t = int(s_t), int(a_t)
-            G = γ*G + r_tt
-            if use_N:
-                update = _mc_step(v, q, t, s_t, a_t, s, a, n_s,
-                    n_sa, G, first_visit)
-            else:
-                update = _mc_step_α(v, q, t, s_t, a_t, s, a,
-                    α, G, first_visit)
-            if optimize and update:
+        if optimize:
+            for s_t in np.unique(s):
                 π.update_policy(q, s_t)
 
-        n_episode += 1
-
         if sample_step and n_episode % sample_step == 0:
-            samples.append(get_sample(MF, v, q, π, n_episode, optimize))
+            samples.append(get_sample(MF, v, q, π, n_episode, optimize, snapshots))
 
     return v, q, samples
 
@@ -295,7 +636,10 @@ def off_policy_mc(states: Sequence[Any], actions: Sequence[Any], transition: Tra
     gamma: float=0.9, first_visit: bool=True, ordinary: bool=False,  
     n_episodes: int=MAX_ITER, max_steps: int=MAX_STEPS, samples: int=1000, 
     optimize: bool=False, policy: ModelFreePolicy=None, eps: float=None, 
-    b: ModelFreePolicy=None) -> Tuple[VQPi, Samples]: 
+    b: ModelFreePolicy=None, n_envs: int=1, vectorized: bool=False,
+    deterministic: bool=False, validate: int=None, n_workers: int=1,
+    replay: EpisodeStore=None, per_decision: bool=False, truncate: float=None
+    ) -> Tuple[VQPi, Samples]: 
     '''Off-policy Monte Carlo state and action value function estimation, policy 
     
     Off policy Monte Carlo method for estimating state and action-value functtions
@@ -303,6 +647,13 @@ def off_policy_mc(states: Sequence[Any], actions: Sequence[Any], transition: Tra
     equal probability one for each (s,a) pair will be used. In order to guarantee
     convergence you must specify 
 
+    Episodes are walked backwards and cut once the importance weight drops
+    below 1E-10. Per-decision importance sampling weights each reward only
+    by the ratios of the actions taken before it, and truncate clips the
+    weights, both trading a little bias for less variance on long episodes.
+    With per_decision, truncate clips every ratio instead of their product,
+    and only ordinary sampling is supported.
+
     Parameters
     ----------
     states : Sequence[Any]
@@ -316,6 +667,12 @@ def off_policy_mc(states: Sequence[Any], actions: Sequence[Any], transition: Tra
         If true, it will only use the first visit to a state, by default True
     ordinary : bool, optional
         ordinary sampling, beware! high variance, by default False
+    per_decision : bool, optional
+        Per-decision importance sampling, returns are averaged as they are
+        already weighted, so it requires ordinary, by default False
+    truncate : float, optional
+        Upper bound of the importance weights, or of each ratio if
+        per_decision, by default None (no bound)
     n_episodes : int, optional
         Number of episodes to simulate, by default 1E4
     max_steps : int, optional
@@ -330,6 +687,25 @@ def off_policy_mc(states: Sequence[Any], actions: Sequence[Any], transition: Tra
         Epsilon for the EpsilonSoftPolicy, by default None (no exploration)
     b : ModelFreePolicy, optional
         Behavior policy, by default None (equal probability ModelFreePolicy)
+    n_envs : int, optional
+        Number of episodes simulated in lockstep per batch, by default 1
+    vectorized : bool, optional
+        If true, transition takes and returns index arrays as described in
+        ModelFree, by default False
+    deterministic : bool, optional
+        If true, the transition is probed for every (s,a) and compiled into
+        lookup tables, see ModelFree.compile_transitions. Stochastic
+        transitions raise a TransitionException, by default False
+    validate : int, optional
+        Number of transitions checked strictly, the rest skip the checks,
+        by default None (all of them)
+    n_workers : int, optional
+        Number of processes generating episodes, by default 1. Each round
+        they get a snapshot of the policy and their own seed, the
+        transition must be picklable.
+    replay : EpisodeStore, optional
+        Episodes recorded following b to learn from instead of simulating
+        them, the first n_episodes are used, by default None
 
     Returns
     -------
@@ -343,6 +719,7 @@ def off_policy_mc(states: Sequence[Any], actions: Sequence[Any], transition: Tra
     Raises
     ------
     TransitionException: transition calls function checks.
+    ValueError: per_decision without ordinary sampling.
     '''
     if not policy and eps:
         _typecheck_all(constants=[eps])
@@ -350,32 +727,43 @@ def off_policy_mc(states: Sequence[Any], actions: Sequence[Any], transition: Tra
         policy = EpsilonSoftPolicy(actions, states, eps=eps)
     elif not policy:
         policy = ModelFreePolicy(actions, states)
-    elif not b:
+    if per_decision and not ordinary:
+        raise ValueError(
+            "per_decision importance sampling is only ordinary, set "
+            "ordinary=True")
+    if not b:
         b = ModelFreePolicy(actions, states)
 
     _typecheck_all(tabular_idxs=[states, actions],transition=transition,
-        constants=[gamma, n_episodes, max_steps, samples],
-        booleans=[first_visit, optimize],
+        constants=[gamma, n_episodes, max_steps, samples, n_envs, n_workers],
+        booleans=[first_visit, optimize, vectorized, deterministic, 
+            per_decision],
         policies=[policy, b])
-    _check_ranges(values=[gamma, n_episodes, max_steps, samples],
-        ranges=[(0,1), (1,np.inf), (1,np.inf), (1,1001)])
+    _check_ranges(values=[gamma, n_episodes, max_steps, samples, n_envs,
+        n_workers], ranges=[(0,1), (1,np.inf), (1,np.inf), (1,1001), 
+        (1,np.inf), (1,np.inf)])
+    if truncate is not None:
+        _typecheck_all(constants=[truncate])
+        _check_ranges(values=[truncate], ranges=[(1E-10, np.inf)])
 
     sample_step = _get_sample_step(samples, n_episodes)
 
-    model = ModelFree(states, actions, transition, gamma=gamma, policy=policy)    
+    model = ModelFree(states, actions, transition, gamma=gamma, policy=policy,
+        vectorized=vectorized, deterministic=deterministic, validate=validate)    
     v, q, samples = _off_policy_monte_carlo(model, b, n_episodes, 
-        max_steps, first_visit, ordinary, optimize, sample_step)
+        max_steps, first_visit, ordinary, optimize, sample_step, n_envs, 
+        n_workers, replay, per_decision, truncate)
 
     return VQPi((v, q, policy)), samples
 
 
-def _mc_step_off(q, v, t, s_t, a_t, s, a, G, w, c, c_q, 
-    first_visit, ordinary):
+def _mc_step_off(q, v, s_t, a_t, G, w, c, c_q, visit_s, visit_sa, 
+    ordinary):
     
     c_add = 1 if ordinary else w
     denom = w if ordinary else 1    
 
-    if s_t not in s[:-(t+1)] or not first_visit:
+    if visit_s:
         c[s_t] = c[s_t] + c_add
         if w < 1E-10:
             if ordinary:
@@ -384,7 +772,7 @@ def _mc_step_off(q, v, t, s_t, a_t, s, a, G, w, c, c_q,
             v[s_t] = v[s_t] + w/c[s_t] * (G - v[s_t]/denom)
         
     q_key = (s_t, a_t)
-    if q_key not in zip(s[:-(t+1)],a[:-(t+1)]) or not first_visit:
+    if visit_sa:
         c_q[q_key] = c_q[q_key] + c_add
         if w < 1E-10:
             if ordinary:
@@ -396,58 +784,315 @@ def _mc_step_off(q, v, t, s_t, a_t, s, a, G, w, c, c_q,
     return False
 
 
-def _off_policy_monte_carlo(MF, off_policy, n_episodes, max_steps, first_visit,
-    ordinary, optimize, sample_step):
+def _mc_step_off_vec(x, c, key, G, w, ordinary, unique=False):
+    '''
+    _mc_step_off over the visits of a whole episode into the flat table x
+    at key, keys may repeat unless unique. As there, weights below 1E-10
+    only add to c.
+    '''
+    if unique:
+        keys, total = key, lambda y: y
+    else:
+        keys, inv = np.unique(key, return_inverse=True)
+        total = lambda y: np.bincount(inv, y, minlength=keys.shape[0])
+
+    live = w >= 1E-10
+    wG = total(np.where(live, w*G, 0))
+    if ordinary:
+        n = total(np.ones(w.shape[0]))
+        c[keys] = c[keys] + n
+    else:
+        n = total(np.where(live, w, 0))
+        c[keys] = c[keys] + total(w)
+    # keys only reached with null weights keep c at 0 when weighted
+    x[keys] = x[keys] + np.divide(wG - n*x[keys], c[keys], 
+        out=np.zeros(keys.shape[0]), where=c[keys] > 0)
+
+
+def _per_decision_returns(r, ρ, γ):
+    '''
+    Per-decision importance sampling returns, G_t = ρ_t(r_t+1 + γG_t+1)
+    for v and r_t+1 + γG_t+1 for q, whose action is already given.
+    '''
+    T = r.shape[0]
+    G_v, G_q = np.empty(T), np.empty(T)
+    g = 0.
+    for t, (r_t, ρ_t) in enumerate(zip(r[::-1].tolist(), ρ[::-1].tolist())):
+        G_q[T-1-t] = r_t + γ*g
+        g = G_v[T-1-t] = ρ_t*G_q[T-1-t]
+    return G_v, G_q
 
+
+def _off_policy_monte_carlo(MF, off_policy, n_episodes, max_steps, first_visit,
+    ordinary, optimize, sample_step, n_envs=1, n_workers=1, replay=None,
+    per_decision=False, truncate=None):
+    '''
+    Without optimization the target policy is fixed, so for episodes of
+    at least VEC_MIN_STEPS the ratios, their backward cumulative product
+    and the returns are computed at once, the steps before the cut
+    dropped, and the updates applied with _mc_step_off_vec. Otherwise the
+    episode is walked backwards step by step, as when optimizing each
+    ratio needs the updated π.
+    '''
     γ = MF.gamma
     b = off_policy 
     π = MF.policy
+    w_max = np.inf if truncate is None else truncate
 
     samples = []
-
-    n_episode = 0
+    snapshots = _Snapshots(MF, optimize,
+        _n_samples(n_episodes, sample_step))
 
     v, q = np.zeros(MF.states.N), np.zeros((MF.states.N, MF.actions.N))
     c, c_q = np.zeros(MF.states.N), np.zeros((MF.states.N, MF.actions.N))
+    q_flat, c_q_flat = q.reshape(-1), c_q.reshape(-1)
 
-    while n_episode < n_episodes:
-        G = 0.
-        s_0, a_0 = MF.random_sa(value=True)
-        episode = MF.generate_episode(s_0, a_0, b, max_steps)
-        sar = np.array(episode)
-        s, a, _ = sar.T
-
-        w = 1.
-        for t, (s_t, a_t, r_tt) in enumerate(sar[::-1]):
-            if w < 1E-10:
-                break
-
-            s_t, a_t = int(s_t), int(a_t)
-            
-            rho = π.pi_as(a_t, s_t)/b.pi_as(a_t, s_t)
-            w = w*rho 
-            
-            G = γ*G + r_tt
-            update = _mc_step_off(q, v, t, s_t, a_t, s, a, 
-                G, w, c, c_q, first_visit, ordinary)
-            
-            if update and optimize:
-                π.update_policy(q, s_t) 
+    episodes = _episodes(MF, b, n_episodes, max_steps, n_envs, 
+        n_workers=n_workers, replay=replay)
+    for n_episode, (s, a, r) in enumerate(episodes, 1):
+        T = s.shape[0]
+        
+        first_s, first_sa = np.ones(T, dtype=bool), np.ones(T, dtype=bool)
+        if first_visit:
+            first_s, first_sa = _first_visits(s, a, MF.actions.N)
+
+        b_sa = b.pi_as(a, s)
+        if optimize or T < VEC_MIN_STEPS:
+            _off_policy_episode(q, v, c, c_q, π, s, a, r, b_sa, γ, 
+                first_s, first_sa, ordinary, per_decision, w_max, optimize)
+        else:
+            ρ = π.pi_as(a, s) / b_sa
+            if per_decision:
+                G_v, G_q = _per_decision_returns(r, np.minimum(ρ, w_max), γ)
+                w, t_0 = np.ones(T), 0
+            else:
+                w = np.cumprod(ρ[::-1])[::-1]
+                cut = np.flatnonzero(w < 1E-10)
+                t_0 = cut[-1] if cut.size else 0
+                G_v = G_q = _returns(r, γ)
+                w = np.minimum(w, w_max)
+
+            m_s, m_sa = first_s[t_0:], first_sa[t_0:]
+            s_, sa_ = s[t_0:], s[t_0:]*MF.actions.N + a[t_0:]
+            _mc_step_off_vec(v, c, s_[m_s], G_v[t_0:][m_s], w[t_0:][m_s],
+                ordinary, first_visit)
+            _mc_step_off_vec(q_flat, c_q_flat, sa_[m_sa], G_q[t_0:][m_sa], 
+                w[t_0:][m_sa], ordinary, first_visit)
         
-        n_episode += 1
-
         if sample_step and n_episode % sample_step == 0:
-            samples.append(get_sample(MF, v, q, π, n_episode, optimize))
+            samples.append(get_sample(MF, v, q, π, n_episode, optimize, snapshots))
     
     return v, q, samples
 
 
+def _off_policy_episode(q, v, c, c_q, π, s, a, r, b_sa, γ, first_s,
+    first_sa, ordinary, per_decision, w_max, optimize):
+    
+    G, w = 0., 1.
+    for t in range(s.shape[0]-1, -1, -1):
+        if w < 1E-10:
+            break
+
+        s_t, a_t = s[t], a[t]
+        rho = π.pi_as(a_t, s_t)/b_sa[t]
+
+        if per_decision:
+            G_q = r[t] + γ*G
+            G = min(rho, w_max)*G_q
+            _mc_step_off(q, v, s_t, a_t, G, 1., c, c_q, first_s[t], False,
+                ordinary)
+            update = _mc_step_off(q, v, s_t, a_t, G_q, 1., c, c_q, False, 
+                first_sa[t], ordinary)
+        else:
+            w = w*rho 
+            G = γ*G + r[t]
+            update = _mc_step_off(q, v, s_t, a_t, G, min(w, w_max), c, c_q, 
+                first_s[t], first_sa[t], ordinary)
+        
+        if update and optimize:
+            π.update_policy(q, s_t) 
+
+
+
+def _backward_order(ends):
+    '''
+    Order walking the steps of the consecutive episodes ending at ends
+    backwards by position, the last step of every episode first, then
+    the second to last, and so on, along with how many episodes are
+    still running at each position. Sorted by length those are a prefix
+    of the episodes, so each position is a contiguous run of the order.
+    '''
+    T = np.diff(ends, prepend=0)
+    order = np.argsort(-T, kind='stable')
+    ends, T = ends[order], T[order]
+    running = np.searchsorted(-T, -np.arange(T[0] if T.size else 0))
+    steps = np.concatenate([ends[:m] - 1 - j for j, m in enumerate(running)]
+        or [np.empty(0, dtype=ends.dtype)])
+    return steps, running
+
+
+def _ope_weights(ρ, r, running, γ):
+    '''
+    Backward weights W_t = Π_{k≥t} ρ_k and returns G_t of KxN steps in
+    _backward_order, and whether each step is reached, no later W of its
+    episode below 1E-10, as in _off_policy_monte_carlo. Every position is
+    a vectorized step over all the episodes still running, so it is O(N)
+    work in max(T) steps.
+    '''
+    K, N = ρ.shape
+    W, G = np.empty((K, N)), np.empty(N)
+    reached = np.empty((K, N), dtype=bool)
+    n = running[0] if running.size else 0
+    w, g, cut = np.ones((K, n)), np.zeros(n), np.zeros((K, n), dtype=bool)
+    i = 0
+    for m in running.tolist():
+        t = slice(i, i + m)
+        reached[:, t] = ~cut[:, :m]
+        w[:, :m] *= ρ[:, t]
+        g[:m] = r[t] + γ*g[:m]
+        W[:, t], G[t] = w[:, :m], g[:m]
+        cut[:, :m] |= w[:, :m] < 1E-10
+        i += m
+    return W, G, reached
+
+
+def off_policy_eval(episodes: Union[EpisodeStore, Sequence[Episode]],
+    policies: Union[ModelFreePolicy, Sequence[ModelFreePolicy]], 
+    b: Union[ModelFreePolicy, np.ndarray]=None, gamma: float=0.9,
+    first_visit: bool=True) -> Tuple[Tuple[np.ndarray, np.ndarray], 
+    Tuple[np.ndarray, np.ndarray]]:
+    '''Offline off-policy evaluation of one or many target policies
+
+    Ordinary and weighted importance sampling estimates of the state and
+    action-value functions of every target policy, from episodes already
+    recorded following a behavior policy b. All the policies are
+    evaluated together, vectorized across episodes in chunks of whole
+    episodes and policies of about OPE_CHUNK steps, with the same updates
+    as off_policy_mc without optimization: returns are weighted by the
+    product of the ratios π(a|s)/b(a|s) from the step onwards, and an
+    episode is cut once that product drops below 1E-10. Sums are taken
+    at once instead of incrementally, so the estimates match the ones of
+    off_policy_mc only up to rounding, which grows with the spread of the
+    weights.
+
+    Parameters
+    ----------
+    episodes : Union[EpisodeStore, Sequence[Tuple[np.ndarray, np.ndarray, np.ndarray]]]
+        Recorded episodes, either an EpisodeStore or (s, a, r) arrays of
+        state and action indexes and rewards.
+    policies : Union[ModelFreePolicy, Sequence[ModelFreePolicy]]
+        Target policies to evaluate.
+    b : Union[ModelFreePolicy, np.ndarray], optional
+        Behavior policy, or the probability b(a_t|s_t) of every recorded 
+        step in order, by default None (the ones held by the EpisodeStore)
+    gamma : float, optional
+        Discount factor, by default 0.9
+    first_visit : bool, optional
+        If true, it will only use the first visit to a state, by default True
+
+    Returns
+    -------
+    ordinary : Tuple[np.ndarray, np.ndarray]
+        Ordinary importance sampling estimates (v, q), of shapes KxS and
+        KxSxA for K target policies.
+    weighted : Tuple[np.ndarray, np.ndarray]
+        Weighted importance sampling estimates (v, q), same shapes.
+
+    Raises
+    ------
+    ValueError: If there are no behavior probabilities, or some of them
+        are not positive.
+    '''
+    if isinstance(policies, ModelFreePolicy):
+        policies = [policies]
+    policies = list(policies)
+
+    _typecheck_all(constants=[gamma], booleans=[first_visit], 
+        policies=policies)
+    _check_ranges(values=[gamma], ranges=[(0,1)])
+
+    if isinstance(episodes, EpisodeStore):
+        s, a, r = episodes.s, episodes.a, episodes.r
+        offsets = episodes.offsets
+        b = episodes.b if b is None else b
+    else:
+        episodes = list(episodes)
+        if not episodes:
+            raise ValueError("No episodes to evaluate")
+        s, a, r = (np.concatenate(x) for x in zip(*episodes))
+        offsets = np.cumsum([0] + [len(e[0]) for e in episodes])
+
+    if isinstance(b, ModelFreePolicy):
+        b = b.pi_as(a, s)
+    if b is None:
+        raise ValueError("Behavior policy or probabilities b are required")
+    b = np.asarray(b, dtype=float)
+    if b.shape != s.shape or not np.all(b > 0):
+        raise ValueError(
+            "b must hold a positive probability for every recorded step")
+
+    γ = gamma
+    S, A = policies[0].S, policies[0].A
+    K = len(policies)
+    n_s, w_s, wg_s = np.zeros(K*S), np.zeros(K*S), np.zeros(K*S)
+    n_sa, w_sa, wg_sa = np.zeros(K*S*A), np.zeros(K*S*A), np.zeros(K*S*A)
+
+    # whole episodes of at most OPE_CHUNK steps, and as many policies at a
+    # time as keep the KxN arrays within OPE_CHUNK entries
+    E, lo = len(offsets) - 1, 0
+    while lo < E:
+        hi = max(lo + 1, np.searchsorted(offsets, offsets[lo] + OPE_CHUNK,
+            side='right') - 1)
+        start, end = offsets[lo], offsets[hi]
+        s_c, a_c = s[start:end], a[start:end]
+
+        first_s = first_sa = np.ones(end - start, dtype=bool)
+        if first_visit:
+            episode = np.repeat(np.arange(hi - lo), np.diff(offsets[lo:hi+1]))
+            first_s, first_sa = _first_visits(episode*S + s_c, a_c, A)
+
+        # from here on steps are in backward order
+        steps, running = _backward_order(offsets[lo+1:hi+1] - start)
+        s_c, a_c, first_s, first_sa = (x[steps] for x in 
+            (s_c, a_c, first_s, first_sa))
+        r_c, b_c = r[start:end][steps], b[start:end][steps]
+
+        k_chunk = max(1, OPE_CHUNK // max(1, end - start))
+        for k_0 in range(0, K, k_chunk):
+            ks = range(k_0, min(K, k_0 + k_chunk))
+            ρ = np.stack([policies[k].pi_as(a_c, s_c) for k in ks]) / b_c
+            W, G, reached = _ope_weights(ρ, r_c, running, γ)
+            WG = np.where(W < 1E-10, 0, W*G)
+            k = np.arange(k_0, ks.stop)[:, None]
+            for key, first, n, acc in ((s_c, first_s, S, (n_s, w_s, wg_s)), 
+                (s_c*A + a_c, first_sa, S*A, (n_sa, w_sa, wg_sa))):
+                mask = reached & first
+                keys = (k*n + key).ravel()
+                for total, x in zip(acc, (mask, mask*W, mask*WG)):
+                    total += np.bincount(keys, x.ravel(), minlength=K*n)
+        lo = hi
+
+    estimates = []
+    for n_visits, sum_w, sum_wg in ((n_s, w_s, wg_s), (n_sa, w_sa, wg_sa)):
+        ordinary = np.divide(sum_wg, n_visits, out=np.zeros_like(sum_wg), 
+            where=n_visits > 0)
+        weighted = np.divide(sum_wg, sum_w, out=np.zeros_like(sum_wg), 
+            where=sum_w > 0)
+        estimates.append((ordinary, weighted))
+
+    (v_o, v_w), (q_o, q_w) = estimates
+    return ((v_o.reshape(K, S), q_o.reshape(K, S, A)), 
+        (v_w.reshape(K, S), q_w.reshape(K, S, A)))
+
+
 
 def tdn(states: Sequence[Any], actions: Sequence[Any], transition: Transition,
     state_0: Any=None, action_0: Any=None, gamma: float=0.9, n: int=1, 
     alpha: float=0.05, n_episodes: int=MAX_ITER, policy: ModelFreePolicy=None, 
     eps: float=None, optimize: bool=False, method: str='sarsa', samples: int=1000, 
-    max_steps: int=MAX_STEPS) -> Tuple[VQPi, Samples]:
+    max_steps: int=MAX_STEPS, n_envs: int=1, vectorized: bool=False,
+    deterministic: bool=False, validate: int=None, replay: EpisodeStore=None
+    ) -> Tuple[VQPi, Samples]:
     '''N-temporal differences algorithm.
 
     Temporal differences algorithm for estimating the value function of a
@@ -482,6 +1127,23 @@ def tdn(states: Sequence[Any], actions: Sequence[Any], transition: Transition,
         Whether to optimize the policy or not, by default False
     samples : int, optional
         Number of samples to take, by default 1000
+    n_envs : int, optional
+        Number of episodes simulated in lockstep per batch, by default 1.
+        Ignored by sarsa_on, which interleaves stepping and updates.
+    vectorized : bool, optional
+        If true, transition takes and returns index arrays as described in
+        ModelFree, by default False
+    deterministic : bool, optional
+        If true, the transition is probed for every (s,a) and compiled into
+        lookup tables, see ModelFree.compile_transitions. Stochastic
+        transitions raise a TransitionException, by default False
+    validate : int, optional
+        Number of transitions checked strictly, the rest skip the checks,
+        by default None (all of them)
+    replay : EpisodeStore, optional
+        Recorded episodes to learn from instead of simulating them, the
+        first n_episodes are used. Not available for sarsa_on, by default
+        None
     
     Returns
     -------
@@ -524,19 +1186,24 @@ def tdn(states: Sequence[Any], actions: Sequence[Any], transition: Transition,
             f'Unknown method {method}\n'
             'Available methods are (sarsa, sarsa_on, qlearning, expected_sarsa'
             ', dqlearning)')
+    if replay is not None and method == 'sarsa_on':
+        raise ValueError('sarsa_on interleaves stepping and updates, it can'
+            ' not replay recorded episodes')
 
     _typecheck_all(tabular_idxs=[states,actions], transition=transition,
-        constants=[gamma, n, alpha, n_episodes, samples, max_steps], 
-        booleans=[optimize], policies=[policy])
+        constants=[gamma, n, alpha, n_episodes, samples, max_steps, n_envs], 
+        booleans=[optimize, vectorized, deterministic], policies=[policy])
+    _check_ranges(values=[n_envs], ranges=[(1,np.inf)])
 
     sample_step = _get_sample_step(samples, n_episodes)
 
-    model = ModelFree(states, actions, transition, gamma=gamma, policy=policy)  
+    model = ModelFree(states, actions, transition, gamma=gamma, policy=policy,
+        vectorized=vectorized, deterministic=deterministic, validate=validate)  
     
     _tdn = METHOD_MAP[method]
 
     v, q, samples = _tdn(model, state_0, action_0, n, alpha, n_episodes,
-        max_steps, optimize, method, sample_step)
+        max_steps, optimize, method, sample_step, n_envs, replay)
     
     return VQPi((v, q, policy)), samples
 
@@ -571,7 +1238,7 @@ def _td_expected_sarsa(s, a, r, t, T, n, v, q, γ, α, gammatron, π=None):
     s_t, a_t, rr = s[t], a[t], r[t:t+n]
     G = np.dot(gammatron[:rr.shape[0]], rr)
     if t + n < T:
-        G = G + (γ**n) * np.dot(π.pi[s[t+n]], q[s[t+n]])
+        G = G + (γ**n) * np.dot(π.pi_s(s[t+n]), q[s[t+n]])
     
     v[s_t] = v[s_t] + α * (G - v[s_t])
     q_key = (s_t, a_t)
@@ -585,8 +1252,53 @@ STEP_MAP = {
 }
 
 
+def _n_step_rewards(r, n, γ):
+    '''
+    Σ_k<n γ^k r_t+k for every step t of the episode, truncated at its end,
+    as a single convolution of the reversed rewards.
+    '''
+    T = r.shape[0]
+    return np.convolve(r[::-1], γ**np.arange(n))[:T][::-1]
+
+
+def _td_episode(s, a, r, n, v, q, γ, α, method, π):
+    '''
+    The STEP_MAP updates of a whole episode under a fixed policy. The
+    n-step reward sums are computed at once, so only the bootstraps, which
+    see the updates of the earlier steps, and the updates themselves are
+    left sequential. That pass runs over python floats, on local copies of
+    the rows of the states visited, written back at the end.
+    '''
+    T = s.shape[0]
+    γ_n = γ**n
+    R = _n_step_rewards(r, n, γ).tolist()
+    states, idx = np.unique(s, return_inverse=True)
+    i_l, a_l = idx.tolist(), a.tolist()
+    v_l, q_l = v[states].tolist(), q[states].tolist()
+    pi_l = π.pi_s(states).tolist()
+
+    for t in range(T):
+        i, a_t = i_l[t], a_l[t]
+        G_v = G_q = R[t]
+        if t + n < T:
+            i_n = i_l[t+n]
+            if method == 'sarsa':
+                G_v = G_v + γ_n * v_l[i_n]
+                G_q = G_q + γ_n * q_l[i_n][a_l[t+n]]
+            elif method == 'qlearning':
+                G_v = G_q = G_v + γ_n * max(q_l[i_n])
+            else:
+                G_v = G_q = G_v + γ_n * sum(
+                    p*x for p, x in zip(pi_l[i_n], q_l[i_n]))
+
+        v_l[i] = v_l[i] + α * (G_v - v_l[i])
+        q_l[i][a_t] = q_l[i][a_t] + α * (G_q - q_l[i][a_t])
+
+    v[states], q[states] = v_l, q_l
+
+
 def _tdn_onoff(MF, s_0, a_0, n, alpha, n_episodes, max_steps, optimize, 
-    method, sample_step):
+    method, sample_step, n_envs=1, replay=None):
     '''N-temporal differences algorithm.
     
     This is the basic implementation of the N-temporal difference algorithm. 
@@ -607,34 +1319,26 @@ def _tdn_onoff(MF, s_0, a_0, n, alpha, n_episodes, max_steps, optimize,
     f_step = STEP_MAP[method]
 
     samples = []
-    n_episode = 0
-    while n_episode < n_episodes:
-        if not s_0:
-           s_0, _ = MF.random_sa(value=True) 
-        if not a_0:
-            _, a_0 = MF.random_sa(value=True)
-        episode = MF.generate_episode(s_0, a_0, π, max_steps)
-        
-        sar = np.array(episode)
-        s, a, r = sar[:,0], sar[:,1], sar[:,2]
-        
-        s = s.astype(int)
-        a = a.astype(int)
-
-        T = s.shape[0]
-        for t in range(T):
-            f_step(s, a, r, t, T, n, v, q, γ, α, gammatron, π)
-            # episode is already set so next step is not generated
-            # via a greedy strategy, each episode generation is greedy
-            if optimize:  
+    snapshots = _Snapshots(MF, optimize,
+        _n_samples(n_episodes, sample_step))
+    s_0, a_0 = _set_s0_a0(MF, s_0, a_0)
+    episodes = _episodes(MF, π, n_episodes, max_steps, n_envs, s_0, a_0,
+        replay=replay)
+    for n_episode, (s, a, r) in enumerate(episodes, 1):
+        if not optimize:
+            _td_episode(s, a, r, n, v, q, γ, α, method, π)
+        else:
+            T = s.shape[0]
+            for t in range(T):
+                f_step(s, a, r, t, T, n, v, q, γ, α, gammatron, π)
+                # episode is already set so next step is not generated
+                # via a greedy strategy, each episode generation is greedy
                 # in/out-place update for current and next episode
                 # off policy without importance weighting
                 π.update_policy(q, s[t]) 
         
-        n_episode += 1
-
         if sample_step and n_episode % sample_step == 0:
-            samples.append(get_sample(MF, v, q, π, n_episode, optimize))
+            samples.append(get_sample(MF, v, q, π, n_episode, optimize, snapshots))
     
     return v, q, samples
 
@@ -654,7 +1358,7 @@ def _td_dq_step(s, a, r, t, T, n, v1, q1, v2, q2, γ, α, gammatron, π):
 
 
 def _double_q(MF, s_0, a_0, n, alpha, n_episodes, max_steps, optimize, 
-    method, sample_step):
+    method, sample_step, n_envs=1, replay=None):
 
     π, α, γ = MF.policy, alpha, MF.gamma
     gammatron = np.array([γ**i for i in range(n)])
@@ -664,17 +1368,12 @@ def _double_q(MF, s_0, a_0, n, alpha, n_episodes, max_steps, optimize,
     v, q = MF.init_vq()
 
     samples = []
-    n_episode = 0
-    while n_episode < n_episodes:
-        s_0, a_0 = _set_s0_a0(MF, s_0, a_0)
-        episode = MF.generate_episode(s_0, a_0, π, max_steps)
-        
-        sar = np.array(episode)
-        s, a, r = sar[:,0], sar[:,1], sar[:,2]
-        
-        s = s.astype(int)
-        a = a.astype(int)
-
+    snapshots = _Snapshots(MF, optimize,
+        _n_samples(n_episodes, sample_step))
+    s_0, a_0 = _set_s0_a0(MF, s_0, a_0)
+    episodes = _episodes(MF, π, n_episodes, max_steps, n_envs, s_0, a_0,
+        replay=replay)
+    for n_episode, (s, a, r) in enumerate(episodes, 1):
         T = s.shape[0]
         for t in range(T):
             if np.random.rand() < 0.5:
@@ -682,22 +1381,22 @@ def _double_q(MF, s_0, a_0, n, alpha, n_episodes, max_steps, optimize,
             else:
                 _td_dq_step(s, a, r, t, T, n, v2, q2, v1, q1, γ, α, gammatron, π)
 
-            v = (v1 + v2)/2
-            q = (q1 + q2)/2
+            # only (s_t, a_t) changed, keep the combined tables in step
+            s_t, a_t = s[t], a[t]
+            v[s_t] = (v1[s_t] + v2[s_t])/2
+            q[s_t, a_t] = (q1[s_t, a_t] + q2[s_t, a_t])/2
             
             if optimize:  
                 π.update_policy(q, s[t])
         
-        n_episode += 1
-
         if sample_step and n_episode % sample_step == 0:
-            samples.append(get_sample(MF, v, q, π, n_episode, optimize))
+            samples.append(get_sample(MF, v, q, π, n_episode, optimize, snapshots))
     
     return v, q, samples
 
 
 def _tdn_on(MF, s_0, a_0, n, alpha, n_episodes, max_steps, optimize,
-    method, sample_step):
+    method, sample_step, n_envs=1, replay=None):
     '''N-temporal differences algorithm for learning.
     
     Super slow and inefficient, but readable and replicated exactly
@@ -709,6 +1408,8 @@ def _tdn_on(MF, s_0, a_0, n, alpha, n_episodes, max_steps, optimize,
     v, q = MF.init_vq()
 
     samples = []
+    snapshots = _Snapshots(MF, optimize,
+        _n_samples(n_episodes, sample_step, first=0))
     n_episode = 0
     while n_episode < n_episodes:
         s_0, a_0 = _set_s0_a0(MF, s_0, a_0)
@@ -748,7 +1449,7 @@ def _tdn_on(MF, s_0, a_0, n, alpha, n_episodes, max_steps, optimize,
                 break
 
         if n_episode % sample_step == 0:
-            samples.append(get_sample(MF, v, q, π, n_episode, optimize))
+            samples.append(get_sample(MF, v, q, π, n_episode, optimize, snapshots))
         n_episode += 1
 
     return v, q, samples
@@ -843,6 +1544,8 @@ def _n_tree_backup(MF, s_0, a_0, n, alpha, n_episodes, max_steps,
     v, q = MF.init_vq()
 
     samples = []
+    snapshots = _Snapshots(MF, optimize,
+        _n_samples(n_episodes, sample_step, first=0))
     n_episode = 0
     while n_episode < n_episodes:
         s_0, a_0 = _set_s0_a0(MF, s_0, a_0)
@@ -868,11 +1571,11 @@ def _n_tree_backup(MF, s_0, a_0, n, alpha, n_episodes, max_steps,
                 if t + 1 >= T:
                     G = R[-1]
                 else:
-                    G = R[t] + γ*np.dot(π.pi[s[t]], q[s[t]])
+                    G = R[t] + γ*np.dot(π.pi_s(s[t]), q[s[t]])
 
                 for k in range(min(t, T-1), tau):
-                    G = R[k-1] + γ*np.dot(π.pi[s[k-1]], q[s[k-1]]) + \
-                        γ*π.pi[s[k-1],A[k-1]]*(G-q[s[k-1], A[k-1]])
+                    G = R[k-1] + γ*np.dot(π.pi_s(s[k-1]), q[s[k-1]]) + \
+                        γ*π.pi_as(A[k-1], s[k-1])*(G-q[s[k-1], A[k-1]])
                 
                 q[S[tau], A[tau]] = q[S[tau], A[tau]] + α[G-q[S[tau], A[tau]]] 
                 
@@ -883,7 +1586,7 @@ def _n_tree_backup(MF, s_0, a_0, n, alpha, n_episodes, max_steps,
                 break
 
         if n_episode % sample_step == 0:
-            samples.append(get_sample(MF, v, q, π, n_episode, optimize))
+            samples.append(get_sample(MF, v, q, π, n_episode, optimize, snapshots))
         n_episode += 1
 
     return v, q, samples
@@ -893,7 +1596,8 @@ def dynaq(states: Sequence[Any], actions: Sequence[Any], transition: Transition,
     state_0: Any=None, action_0: Any=None, gamma: float=1.0, kappa: float=0.01, 
     n: int=1, plus: bool=False, alpha: float=0.05, n_episodes: int=MAX_ITER,
     policy: ModelFreePolicy=None, eps: float=None, samples: int=1000,
-    max_steps: int=MAX_STEPS) -> Tuple[VQPi, Samples]:
+    max_steps: int=MAX_STEPS, deterministic: bool=False, validate: int=None
+    ) -> Tuple[VQPi, Samples]:
     '''
     TODO: docs
     '''
@@ -901,13 +1605,14 @@ def dynaq(states: Sequence[Any], actions: Sequence[Any], transition: Transition,
 
     _typecheck_all(tabular_idxs=[states,actions], transition=transition,
         constants=[gamma, kappa, n, alpha, n_episodes, samples, max_steps], 
-        booleans=[plus], policies=[policy])
+        booleans=[plus, deterministic], policies=[policy])
 
     # check ranges
     
     sample_step = _get_sample_step(samples, n_episodes)
 
-    model = ModelFree(states, actions, transition, gamma=gamma, policy=policy)
+    model = ModelFree(states, actions, transition, gamma=gamma, policy=policy,
+        deterministic=deterministic, validate=validate)
     v, q, samples = _dyna_q(model, state_0, action_0, n, alpha, kappa, plus,
         n_episodes, max_steps, sample_step)
 
@@ -927,6 +1632,8 @@ def _dyna_q(MF, s_0, a_0, n, alpha, kappa, plus, n_episodes, max_steps,
     times_sa = np.zeros((S, A), dtype=int)
 
     samples = []
+    snapshots = _Snapshots(MF, True,
+        _n_samples(n_episodes, sample_step, first=0))
     current_t = 0
     n_episode = 0
     while n_episode < n_episodes:
@@ -964,7 +1671,7 @@ def _dyna_q(MF, s_0, a_0, n, alpha, kappa, plus, n_episodes, max_steps,
                 break 
         
         if n_episode % sample_step == 0:
-            samples.append(get_sample(MF, v, q, π, n_episode, True))
+            samples.append(get_sample(MF, v, q, π, n_episode, True, snapshots))
         n_episode += 1
 
     return v, q, samples
@@ -974,41 +1681,53 @@ def priosweep(states: Sequence[Any], actions: Sequence[Any], transition: Transit
     state_0: Any=None, action_0: Any=None, gamma: float=1.0, theta: float=0.01, 
     n: int=1, plus: bool=False, alpha: float=0.05, n_episodes: int=MAX_ITER,
     policy: ModelFreePolicy=None, eps: float=None, samples: int=1000,
-    max_steps: int=MAX_STEPS) -> Tuple[VQPi, Samples]:
+    max_steps: int=MAX_STEPS, deterministic: bool=False, validate: int=None,
+    capacity: int=None) -> Tuple[VQPi, Samples]:
     '''
     TODO: docs
+
+    capacity bounds the number of (s,a) queued for planning, evicting the
+    lowest priority ones, by default None (unbounded).
     '''
     policy = _set_policy(policy, eps, actions, states)
 
     _typecheck_all(tabular_idxs=[states,actions], transition=transition,
         constants=[gamma, theta, n, alpha, n_episodes, samples, max_steps], 
-        booleans=[plus], policies=[policy])
+        booleans=[plus, deterministic], policies=[policy])
+    if capacity is not None:
+        _typecheck_all(constants=[capacity])
+        _check_ranges(values=[capacity], ranges=[(1, np.inf)])
 
     # check ranges
     
     sample_step = _get_sample_step(samples, n_episodes)
 
-    model = ModelFree(states, actions, transition, gamma=gamma, policy=policy)
+    model = ModelFree(states, actions, transition, gamma=gamma, policy=policy,
+        deterministic=deterministic, validate=validate)
     v, q, samples = _priosweep(model, state_0, action_0, n, alpha, theta, 
-        n_episodes, max_steps, sample_step)
+        n_episodes, max_steps, sample_step, capacity)
 
     return VQPi((v, q, policy)), samples
 
 
 def _priosweep(MF, s_0, a_0, n, alpha, theta, n_episodes, max_steps, 
-        sample_step):
+        sample_step, capacity=None):
 
     π, α, γ = MF.policy, alpha, MF.gamma
     v, q = MF.init_vq()
     
-    P, Pq, θ = 0, PQueue([]), theta 
+    P, Pq, θ = 0, PQueue(capacity=capacity), theta 
 
     S, A = MF.states.N, MF.actions.N
-    model_sas = np.zeros((S, A), dtype=int)
+    model_sas = np.full((S, A), -1, dtype=int)
     model_sar = np.zeros((S, A), dtype=float)
     times_sa = np.zeros((S, A), dtype=int)
+    # reverse index of model_sas, next state: {(s,a) leading to it}
+    predecessors = defaultdict(set)
 
     samples, current_t, n_episode = [], 0, 0
+    snapshots = _Snapshots(MF, True,
+        _n_samples(n_episodes, sample_step, first=0))
     while n_episode < n_episodes:
         s_0, _ = _set_s0_a0(MF, s_0, None)
 
@@ -1019,6 +1738,9 @@ def _priosweep(MF, s_0, a_0, n, alpha, theta, n_episodes, max_steps,
             a = π(s)
             (s_, r), end = MF.step_transition(s, a) # real next state
             times_sa[s, a] = current_t
+            if model_sas[s, a] != s_:
+                predecessors[model_sas[s, a]].discard((s, a))
+                predecessors[s_].add((s, a))
             model_sas[s, a] = s_
             model_sar[s, a] = r
 
@@ -1039,13 +1761,11 @@ def _priosweep(MF, s_0, a_0, n, alpha, theta, n_episodes, max_steps,
                 
                 q[ps, pa] = q[ps, pa] + α*(R + γ*np.max(q[s_m]) - q[ps, pa])
 
-                # grab all the index where model_sas == s
-                mmask = (model_sas == s)
-                for ss, aa in zip(*np.where(mmask)):
+                for ss, aa in predecessors[ps]:
                     rr = model_sar[ss, aa]
-                    P = np.abs(rr + γ*np.max(q[s]) - q[ss, aa])
+                    P = np.abs(rr + γ*np.max(q[ps]) - q[ss, aa])
                     if P > θ:
-                        Pq.push((s, a), P)
+                        Pq.push((ss, aa), P)
                 
             π.update_policy(q, s_)
             s = s_ # current state equal next state
@@ -1053,7 +1773,7 @@ def _priosweep(MF, s_0, a_0, n, alpha, theta, n_episodes, max_steps,
                 break 
         
         if n_episode % sample_step == 0:
-            samples.append(get_sample(MF, v, q, π, n_episode, True))
+            samples.append(get_sample(MF, v, q, π, n_episode, True, snapshots))
         n_episode += 1
 
     return v, q, samples
\ No newline at end of file
@@ -1,3 +1,4 @@
+import heapq
 from abc import ABC, abstractmethod
 from typing import (
     Any, 
@@ -46,6 +47,14 @@ class _TabularIndexer():
     def from_index(self, idx) -> Any:
         return self.revindex[idx]
 
+    def get_indices(self, values: Sequence[Any]) -> np.ndarray:
+        '''
+        get_index of every value in values as an int array, still one
+        dict lookup per value
+        '''
+        return np.fromiter((self.index[v] for v in values), dtype=np.int64,
+            count=len(values))
+
     def random(self, value=False):
         rnd_idx = np.random.choice(self.N)
         if value:
@@ -65,11 +74,153 @@ class StateAction(_TabularIndexer):
     pass
 
 
+def _objects(seq: Sequence[Any]) -> np.ndarray:
+    # object array holding the values of seq as they are, tuples included
+    values = np.empty(len(seq), dtype=object)
+    for i, v in enumerate(seq):
+        values[i] = v
+    return values
+
+
+class MixedRadixState(State, Sequence):
+    '''
+    State indexer for product state spaces, e.g. gridworld (x, y) or
+    blackjack (player_sum, usable_ace, dealer_showing). States are tuples
+    with one value per dimension, taken from dims[i], and their index is a
+    mixed-radix number with a digit per dimension, the last one varying
+    fastest. get_index and from_index are arithmetic over the strides of
+    the digits and memory is O(dims) instead of O(S) dicts, while
+    get_indices and from_indices encode and decode whole arrays of states
+    at once.
+
+    A dimension is an int n, values 0..n-1, a range or any other sequence
+    of values, e.g. [False, True], the latter looked up in a dict over
+    its own values.
+
+    Being a Sequence of its states it can be passed wherever states are
+    expected, e.g. tdn(MixedRadixState([4, 12]), actions, transition).
+    '''
+    def __init__(self, dims: Sequence[Any]):
+        self.dims = [range(d) if isinstance(d, int) else d for d in dims]
+        self.radix = tuple(len(d) for d in self.dims)
+        self.N = int(np.prod(self.radix))
+        self.seq = self
+        self._digits = [None if isinstance(d, range) else 
+            {v: i for i, v in enumerate(d)} for d in self.dims]
+        self._values = [None if isinstance(d, range) else _objects(d) 
+            for d in self.dims]
+        strides = np.cumprod((self.radix + (1,))[:0:-1])[::-1].tolist()
+        self._place = tuple(
+            (d.start, d.step, r, stride, None) if dmap is None else 
+            (0, 1, r, stride, dmap) for d, r, stride, dmap in 
+            zip(self.dims, self.radix, strides, self._digits))
+
+    def __len__(self) -> int:
+        return self.N
+
+    def __getitem__(self, idx: int) -> Tuple:
+        if idx < 0:
+            idx += self.N
+        if not 0 <= idx < self.N:
+            raise IndexError(f'state index {idx} out of range')
+        return self.from_index(idx)
+
+    def get_index(self, v) -> int:
+        if len(v) != len(self._place):
+            raise KeyError(v)
+        idx = 0
+        for x, (start, step, r, stride, digits) in zip(v, self._place):
+            if digits is not None:
+                x = digits[x]
+            i, rem = divmod(x - start, step)
+            if rem or not 0 <= i < r:
+                raise KeyError(v)
+            idx += i*stride
+        return int(idx)
+
+    def from_index(self, idx: int) -> Tuple:
+        if not 0 <= idx < self.N:
+            raise KeyError(idx)
+        return tuple(d[idx // stride % r] for d, (_, _, r, stride, _) in 
+            zip(self.dims, self._place))
+
+    def get_indices(self, values: Sequence[Any]) -> np.ndarray:
+        '''
+        get_index of every state in values, either a sequence of tuples
+        or an array with a column per dimension, as an int array
+        '''
+        if not isinstance(values, np.ndarray):
+            values = list(zip(*values)) or [[]]*len(self.dims)
+        else:
+            values = values.T
+        if len(values) != len(self.dims):
+            raise KeyError('states must have a value per dimension')
+
+        digits = []
+        for col, d, r, dmap in zip(values, self.dims, self.radix, 
+            self._digits):
+            if dmap is not None:
+                digits.append(np.fromiter((dmap[x] for x in col), 
+                    dtype=np.int64, count=len(col)))
+                continue
+            i, rem = np.divmod(np.asarray(col, dtype=np.int64) - d.start, 
+                d.step)
+            if np.any(rem) or np.any((i < 0) | (i >= r)):
+                raise KeyError(f'values out of {d}')
+            digits.append(i)
+        return np.ravel_multi_index(digits, self.radix)
+
+    def from_indices(self, idx: np.ndarray) -> Tuple[np.ndarray, ...]:
+        '''
+        States at every index in idx, as an array of values per dimension
+        '''
+        digits = np.unravel_index(np.asarray(idx), self.radix)
+        return tuple(d.start + i*d.step if values is None else values[i] 
+            for d, values, i in zip(self.dims, self._values, digits))
+
+
 class _TabularValues:
+    '''
+    Zero-copy view of a value table indexed by idx: values[k] looks k up
+    through the indexer, get(keys) gathers the values of many keys with a
+    single array indexing. For Qpi the keys are states and each value a
+    row over the actions. idx_val is built on first access and kept
+    until v is reassigned.
+    '''
     def __init__(self, values: np.ndarray, idx: _TabularIndexer):
         self.v = values
         self.idx = idx
-        self.idx_val = {k:v for k,v in zip(idx.index.keys(), values)}
+
+    @property
+    def v(self) -> np.ndarray:
+        return self._v
+
+    @v.setter
+    def v(self, values: np.ndarray):
+        self._v = np.asarray(values)
+        self._idx_val = None
+
+    def __getitem__(self, key):
+        return self.v[self.idx.get_index(key)]
+
+    def __len__(self) -> int:
+        return self.v.shape[0]
+
+    def get(self, keys: Sequence[Any]) -> np.ndarray:
+        '''
+        Values of every key in keys, stacked in order
+        '''
+        return self.v[self.idx.get_indices(keys)]
+
+    @property
+    def idx_val(self) -> dict:
+        '''
+        key: value dict, prefer [] or get for a few keys
+        '''
+        if self._idx_val is None:
+            self._idx_val = {self.idx.from_index(i): v 
+                for i, v in zip(range(self.idx.N), self._v)}
+        return self._idx_val
 
     def values(self):
         return self.v
@@ -81,7 +232,7 @@ class Vpi(_TabularValues):
 
 class Qpi(_TabularValues):
     def __str__(self):
-        return f'Vpi({self.v[:5]}...)'
+        return f'Qpi({self.v[:5]}...)'
 
 
 VQPi = NewType('VQPi', Tuple[Vpi, Qpi, Policy])
@@ -90,22 +241,92 @@ Transition = Callable[[Any, Any], Tuple[Tuple[Any, float], bool]]
 
 
 class PQueue:
-    def __init__(self, items: List[Tuple[float, Any]]):
-        self.items = items
-        self._sort()
-    
-    def _sort(self):
-        self.items.sort(key=lambda x: x[0])
-    
-    def push(self, item, priority):
-        self.items.append((priority, item))
-        self._sort()
-    
+    '''
+    Indexed max priority queue: pop returns the item with the highest
+    priority. Each item is queued at most once, pushing it again only
+    raises its priority while update sets it either way. Replaced entries
+    are left in a binary heap and skipped when they reach the top, so
+    push, update and pop are O(log N).
+
+    With a capacity, pushing a new item into a full queue evicts the
+    lowest priority one, found through a second heap, or drops the new
+    item if it has the lowest priority of all. The capacity must be at
+    least 1, else a ValueError is raised.
+    '''
+    def __init__(self, items: List[Tuple[float, Any]] = None, 
+        capacity: int = None):
+        if capacity is not None:
+            _check_ranges(values=[capacity], ranges=[(1, np.inf)])
+        self.capacity = capacity
+        self._entries = {} # item: (priority, count)
+        self._max, self._min = [], []
+        self._count = 0
+        for priority, item in items or []:
+            self.push(item, priority)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, item) -> bool:
+        return item in self._entries
+
+    def _live(self, key, item) -> bool:
+        return self._entries.get(item) == key
+
+    def _top(self, heap, sign):
+        while heap:
+            p, count, item = heap[0]
+            if self._live((sign*p, count), item):
+                return item
+            heapq.heappop(heap)
+        return None
+
+    def _compact(self):
+        self._max = [(-p, c, i) for i, (p, c) in self._entries.items()]
+        heapq.heapify(self._max)
+        if self.capacity is not None:
+            self._min = [(p, c, i) for i, (p, c) in self._entries.items()]
+            heapq.heapify(self._min)
+
+    def push(self, item, priority: float):
+        key = self._entries.get(item)
+        if key is None or priority > key[0]:
+            self.update(item, priority)
+
+    def update(self, item, priority: float):
+        if item not in self._entries and self.capacity is not None \
+            and len(self._entries) >= self.capacity:
+            lowest = self._top(self._min, 1)
+            if priority <= self._entries[lowest][0]:
+                return
+            self.remove(lowest)
+
+        self._count += 1
+        self._entries[item] = (priority, self._count)
+        heapq.heappush(self._max, (-priority, self._count, item))
+        if self.capacity is not None:
+            heapq.heappush(self._min, (priority, self._count, item))
+
+        if max(len(self._max), len(self._min)) > 2*len(self._entries) + 64:
+            self._compact()
+
+    def remove(self, item):
+        del self._entries[item]
+
+    def priority(self, item) -> float:
+        return self._entries[item][0]
+
     def pop(self):
-        return self.items.pop(0)[1]
+        item = self._top(self._max, -1)
+        if item is None:
+            raise IndexError('pop from an empty PQueue')
+        heapq.heappop(self._max)
+        del self._entries[item]
+        return item
+
+    def empty(self) -> bool:
+        return len(self._entries) == 0
 
-    def empty(self):
-        return len(self.items) == 0
 
 class RewardGenerator:
     DISTRIBUTION = {